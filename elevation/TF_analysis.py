@@ -1,6 +1,5 @@
 import mne
 import pathlib
-import pickle
 DIR = pathlib.Path.cwd()
 eeg_DIR = DIR / 'elevation' / 'data'
 import matplotlib
@@ -8,15 +7,19 @@ matplotlib.use('TkAgg')
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
-import math
+from tf_tools import event_locked_power, event_locked_tfr, baseline_normalize, condition_averages, WaveletBank
+from montage_registry import MontageRegistry
+from brainvision_io import read_events
 subj_name = 'Leonie'
 
 # load raw data
 raw = mne.io.read_raw_brainvision(eeg_DIR / str(subj_name + '_1.vhdr'), preload=True)
 
+# parsed montages / mapping are stored in the data folder and reused by later runs
+registry = MontageRegistry(cache_dir=eeg_DIR / 'cache')
+
 # load channel name mapping and rename channels
-with open('channel_mapping.pkl', 'rb') as f:
-    mapping = pickle.load(f)
+mapping = registry.mapping(DIR / 'channel_mapping.pkl')
 raw.rename_channels(mapping)
 
 # add reference channel
@@ -24,8 +27,8 @@ raw = mne.add_reference_channels(raw, 'FCz', copy=True)
 
 # load and apply montage
 montage_path = DIR / "AS-96_REF_c.bvef"
-montage = mne.channels.read_custom_montage(fname=montage_path)
-raw.set_montage(montage)
+montage = registry.montage(montage_path)
+raw.set_montage(montage.to_mne())
 
 # reference = ['PO9', 'PO10']  # set average of both mastoid electrodes as reference
 reference = 'average'  # alternatively use avg reference
@@ -35,8 +38,8 @@ raw.set_eeg_reference(reference)
 raw.filter(l_freq=0.5, h_freq=40)
 
 # load and name events
-events = mne.events_from_annotations(raw)[0]  # load events
 event_id = dict(up=1, down=2, left=3, right=4, front=5)  # assign event id's to the trigger numbers
+events = read_events(eeg_DIR / str(subj_name + '_1.vhdr'), event_id)  # from the .vmrk file, codes checked
 
 # set epoch times
 tmin = -0.2
@@ -78,63 +81,37 @@ fs = raw.info['sfreq']
 eeg_data = raw._data[64]
 eeg_time = np.arange(0, len(eeg_data) / fs, 1 / fs)  # start, stop, step size
 
-# def tf_analysis(raw, min_freq, max_freq, num_frex):
 # define frequency range
 min_freq = 2
 max_freq = 20
 num_frex = int(max_freq - min_freq / 2)
-# define wavelet parameters
-time = np.arange(-1, 1, 1 / fs)
 frex = np.logspace(np.log10(min_freq), np.log10(max_freq), num_frex)
 # number of cycles of morlet wavelet as function of frequency (more cycles with increasing wavelet frequency)
-s = np.logspace(np.log10(3), np.log10(10), num_frex) / (2 * np.pi * frex)
-# define convolution parameters
-n_wavelet = len(time)
-n_data = len(eeg_data)
-n_convolution = n_wavelet + n_data - 1
-n_conv_pow2 = 2 ** (math.ceil(math.log(n_convolution, 2)))
-half_of_wavelet_size = int((n_wavelet - 1) / 2)
-# get FFT of data
-eeg_fft = np.fft.fft(eeg_data, n_conv_pow2)
-# initialize
-eeg_power = np.zeros((num_frex, n_data))  # frequencies X time
-# loop through frequencies and compute synchronization
-for fi in range(num_frex):
-    wavelet_fft = \
-    np.fft.fft(np.sqrt(1 / (s[fi] * np.sqrt(np.pi)))  #todo empirical scaling factor for varying wavelet cycles
-               # complex sine at different frequencies
-               * np.exp(2 * 1j * np.pi * frex[fi] * time)
-               # gaussian with s cycles
-               * np.exp(-time ** 2 / (2 * (s[fi] ** 2))), n_conv_pow2)  # more cycles with increasing wavelet frequency
-    # convolution
-    eeg_conv = np.fft.ifft(wavelet_fft * eeg_fft)  # convolve
-    eeg_conv = eeg_conv[:n_convolution]  # cut result to length of n_convolution
-    eeg_conv = eeg_conv[half_of_wavelet_size + 1: n_convolution - half_of_wavelet_size]
-    # calculate power
-    temp_power = (np.abs(eeg_conv) ** 2)
-    # # baseline normalization
-    eeg_power[fi] = 10*np.log10(temp_power)
-
-# get stimulus onset times (up: 1, down: 2, left: 3, right: 4, front: 5)
-# select stimulus
-stim_id = 3
+n_cycles = np.logspace(np.log10(3), np.log10(10), num_frex)
+# wavelet ffts are stored on disk and reused by every run / subject with the same parameters
+bank = WaveletBank(cache_dir=eeg_DIR / 'wavelet_cache')
 
 # set epoch times
 tmin=-0.2
 tmax=0.3
 
-stim_times = events[events[:, 2] == stim_id][:, 0]
-epoch_tf = np.zeros((len(stim_times), num_frex, int(tmax*fs-tmin*fs)))
+# get stimulus onset times of all conditions (up: 1, down: 2, left: 3, right: 4, front: 5)
+stim_events = events[np.isin(events[:, 2], list(event_id.values()))]
+stim_times = stim_events[:, 0]
+
+# convolve only the data around each stimulus, all frequencies at once
+# (pass raw._data instead of eeg_data to get events X channels X frequencies X time;
+# morlet_power(eeg_data, fs, frex, n_cycles) gives the power of the whole recording)
+epoch_tf = 10 * np.log10(event_locked_power(eeg_data, stim_times, fs, frex, n_cycles, tmin, tmax, bank=bank))
 
-# get epoch data
-for i in range(len(stim_times)):
-    # get data around each event
-    epoch_tf[i] = eeg_power[:, stim_times[i]+int(fs*tmin):stim_times[i]+int(fs*tmax)]
-    # baseline
-    for fi in range(num_frex):
-        epoch_tf[i, fi] = epoch_tf[i, fi] / np.mean(epoch_tf[i, fi, :int(-tmin * fs)])
-# average across epochs
-evoked_tf = np.mean(epoch_tf, axis=0)
+# baseline (divide by the mean of the pre-stimulus period; 'db', 'percent' and 'zscore' are also available)
+epoch_tf = baseline_normalize(epoch_tf, fs, tmin, baseline=(None, 0), mode='ratio')
+# average across epochs of each condition
+condition_tfs = condition_averages(epoch_tf, stim_events[:, 2], event_id)
+
+# select stimulus
+stim_id = 3
+evoked_tf = condition_tfs[list(event_id.keys())[list(event_id.values()).index(stim_id)]]
 
 # plot
 epoch_time = np.arange(tmin, len(evoked_tf[1]) / fs+tmin, 1 / fs)
@@ -145,4 +122,17 @@ c_ax = ax.contourf(x, y, evoked_tf, norm=colors.Normalize(), cmap=plt.cm.jet)
 cbar = fig.colorbar(c_ax)
 plt.show()
 plt.vlines(0,ymin=frex.min(), ymax=frex.max(), colors='k', linestyles='dashed')
-plt.title(list(event_id.keys())[list(event_id.values()).index(stim_id)])
\ No newline at end of file
+plt.title(list(event_id.keys())[list(event_id.values()).index(stim_id)])
+# all channels: average power and inter-trial phase coherence per condition in one pass,
+# decimated by 3 (as the tfr_morlet call above) and stored as float32, without single-trial maps
+power, itc, n_trials = event_locked_tfr(raw._data, events, event_id, fs, frex, n_cycles, tmin, tmax, decim=3,
+                                        bank=bank)
+tfr_time = tmin + np.arange(0, int(tmax * fs - tmin * fs), 3) / fs
+power_db = {name: 10 * np.log10(baseline_normalize(p, fs / 3, tmin, baseline=(None, 0))) for name, p in power.items()}
+ch = raw.ch_names.index('FCz')
+fig, axes = plt.subplots(1, 2, sharey=True)
+for ax, tf, label in zip(axes, [power_db['left'][ch], itc['left'][ch]], ['power (dB)', 'ITC']):
+    c_ax = ax.contourf(tfr_time, frex, tf, cmap=plt.cm.jet)
+    fig.colorbar(c_ax, ax=ax, label=label)
+    ax.vlines(0, ymin=frex.min(), ymax=frex.max(), colors='k', linestyles='dashed')
+axes[0].set(title=f'left, FCz (n={n_trials["left"]})', xlabel='time (s)', ylabel='frequency (Hz)')
@@ -0,0 +1,28 @@
+"""
+LRU cache of read-only arrays in memory, backed by .npy files (used for the spline matrices and wavelet banks).
+"""
+import numpy as np
+
+
+def cached_array(arrays, name, compute, max_size, cache_dir=None):
+    """
+    arrays[name] from the OrderedDict arrays (an LRU cache of max_size entries), else loaded from
+    cache_dir / f'{name}.npy', else compute() (also saved there if cache_dir is given); the array is read-only
+    """
+    if name in arrays:
+        arrays.move_to_end(name)
+        return arrays[name]
+    array = None
+    fname = cache_dir / f'{name}.npy' if cache_dir is not None else None
+    if fname is not None and fname.exists():
+        array = np.load(fname)
+    if array is None:
+        array = compute()
+        if fname is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            np.save(fname, array)
+    array.setflags(write=False)
+    arrays[name] = array
+    while len(arrays) > max_size:
+        arrays.popitem(last=False)
+    return array
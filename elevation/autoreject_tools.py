@@ -0,0 +1,148 @@
+"""
+AutoReject-style rejection (Jas et al. 2017): per-channel peak-to-peak thresholds and the (n_interpolate,
+consensus) pair are chosen by cross-validation on a process pool, and the fit is cached per subject.
+"""
+import json
+import pathlib
+import mne
+import numpy as np
+from montage_registry import default_registry
+from pipeline_cache import data_key
+from profiling import profiled
+from worker_pool import map_tasks, shared, worker_pool
+
+
+def _folds(n_epochs, cv, random_state):
+    splits = np.array_split(np.random.default_rng(random_state).permutation(n_epochs), cv)
+    return [(np.sort(np.concatenate(splits[:k] + splits[k + 1:])), np.sort(splits[k])) for k in range(cv)]
+
+
+def _channel_errors(channels, n_thresholds):
+    """ cross-validation error of every candidate threshold for the given channels """
+    data, ptp, folds, medians = shared['data'], shared['ptp'], shared['folds'], shared['medians']
+    results = {}
+    for ch in channels:
+        candidates = np.linspace(ptp[:, ch].min(), ptp[:, ch].max(), n_thresholds)
+        errors = np.zeros(n_thresholds)
+        for (train, test), median in zip(folds, medians):
+            order = np.argsort(ptp[train, ch])
+            # mean of the k smallest-ptp training epochs for every k at once
+            cumsum = np.cumsum(data[train[order], ch], axis=0)
+            k = np.searchsorted(ptp[train[order], ch], candidates, side='right')
+            means = cumsum[np.maximum(k, 1) - 1] / np.maximum(k, 1)[:, None]
+            fold_error = np.sqrt(np.mean((means - median[ch]) ** 2, axis=-1))
+            errors += np.where(k > 0, fold_error, np.inf)
+        results[ch] = (candidates, errors)
+    return results
+
+
+def _interpolation_matrix(info, picks, bad):
+    """ (channels x channels) matrix replacing the bad channels by a spherical spline of the good ones """
+    matrix = np.eye(len(picks))
+    if bad:
+        bad_idx = list(bad)
+        good_idx = np.setdiff1d(np.arange(len(picks)), bad_idx)
+        matrix[bad_idx] = 0.
+        # spline matrices are shared by all subjects / reruns with the same bad channels
+        matrix[np.ix_(bad_idx, good_idx)] = default_registry.interpolation_matrix(
+            info, [info['ch_names'][picks[i]] for i in bad_idx], picks)
+    return matrix
+
+
+def _interpolation(bad):
+    # cached per worker
+    cache = shared['interp']
+    if bad not in cache:
+        cache[bad] = _interpolation_matrix(shared['info'], shared['picks'], bad)
+    return cache[bad]
+
+
+def _repair_plan(ptp, thresholds, n_interpolate, consensus):
+    """ per epoch: kept or not, and the tuple of channels to interpolate """
+    ratio = ptp / thresholds
+    bad = ratio > 1
+    n_bad = bad.sum(axis=1)
+    keep = n_bad <= consensus * ptp.shape[1]
+    worst = np.argsort(-ratio, axis=1)
+    plans = [tuple(sorted(worst[i, :min(n_bad[i], n_interpolate)])) for i in range(len(ptp))]
+    return keep, plans
+
+
+def _cleaned_mean(data, epochs, ptp, thresholds, n_interpolate, consensus):
+    """ mean of data[epochs] after dropping and interpolating as _repair_plan says """
+    keep, plans = _repair_plan(ptp[epochs], thresholds, n_interpolate, consensus)
+    if not keep.any():
+        return None
+    groups = {}
+    for epoch, plan in zip(epochs[keep], [p for p, k in zip(plans, keep) if k]):
+        groups.setdefault(plan, []).append(epoch)
+    # interpolation is linear: sum the epochs sharing a bad-channel set and interpolate the sum once
+    total = sum(_interpolation(bad) @ data[group].sum(axis=0) for bad, group in groups.items())
+    return total / keep.sum()
+
+
+def _pair_error(thresholds, n_interpolate, consensus):
+    data, ptp, folds, medians = shared['data'], shared['ptp'], shared['folds'], shared['medians']
+    error = 0.
+    for (train, test), median in zip(folds, medians):
+        mean = _cleaned_mean(data, train, ptp, thresholds, n_interpolate, consensus)
+        if mean is None:
+            return np.inf
+        error += np.sqrt(np.mean((mean - median) ** 2))
+    return error / len(folds)
+
+
+@profiled('autoreject_fit')
+def fit_autoreject(epochs, n_interpolate=(3, 6, 12), consensus=np.linspace(0, 1, 11), cv=10, n_thresholds=40,
+                   random_state=42, n_jobs=1, cache_dir=None, name='autoreject'):
+    """
+    fit per-channel thresholds and the best (n_interpolate, consensus) on the EEG channels with n_jobs processes;
+    with cache_dir the fit is stored per data and parameters and reloaded. Returns a json-able dict.
+    """
+    picks = mne.pick_types(epochs.info, eeg=True, exclude=[])
+    data = epochs.get_data(picks=picks)
+    params = dict(n_interpolate=[int(n) for n in n_interpolate], consensus=[float(c) for c in consensus],
+                  cv=cv, n_thresholds=n_thresholds, random_state=random_state)
+    fname = None
+    if cache_dir is not None:
+        fname = pathlib.Path(cache_dir) / f'{name}_{data_key(params, data)}-autoreject.json'
+        if fname.exists():
+            with open(fname) as f:
+                return json.load(f)
+    ptp = data.max(axis=-1) - data.min(axis=-1)  # computed once, used for every candidate
+    folds = _folds(len(data), cv, random_state)
+    # test-fold medians don't depend on the candidate, compute them once
+    medians = [np.median(data[test], axis=0) for train, test in folds]
+    with worker_pool(n_jobs, data=data, ptp=ptp, folds=folds, medians=medians, info=epochs.info, picks=picks,
+                     interp={}) as pool:
+        channel_chunks = np.array_split(np.arange(len(picks)), max(n_jobs, 1))
+        thresholds = np.zeros(len(picks))
+        for results in map_tasks(pool, _channel_errors, [(chunk, n_thresholds) for chunk in channel_chunks]):
+            for ch, (candidates, errors) in results.items():
+                thresholds[ch] = candidates[np.argmin(errors)]
+        pairs = [(n, c) for n in params['n_interpolate'] for c in params['consensus']]
+        errors = map_tasks(pool, _pair_error, [(thresholds, n, c) for n, c in pairs])
+    best_n, best_c = pairs[int(np.argmin(errors))]
+    fit = dict(ch_names=[epochs.ch_names[i] for i in picks], thresholds=thresholds.tolist(),
+               n_interpolate=best_n, consensus=best_c, params=params)
+    if fname is not None:
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        with open(fname, 'w') as f:
+            json.dump(fit, f, indent=2)
+    return fit
+
+
+def apply_autoreject(epochs, fit):
+    """ drop / interpolate epochs in place as fitted; returns (epochs, epochs x channels threshold crossings) """
+    picks = np.array([epochs.ch_names.index(ch) for ch in fit['ch_names']])
+    data = epochs.get_data(picks=picks, copy=False)
+    ptp = data.max(axis=-1) - data.min(axis=-1)
+    thresholds = np.asarray(fit['thresholds'])
+    keep, plans = _repair_plan(ptp, thresholds, fit['n_interpolate'], fit['consensus'])
+    for bad in set(plans):
+        if bad:
+            group = [i for i, plan in enumerate(plans) if plan == bad]
+            matrix = _interpolation_matrix(epochs.info, picks, bad)
+            epochs._data[np.ix_(group, picks)] = np.einsum('ij,ejt->eit', matrix, data[group])
+    epochs.drop(np.flatnonzero(~keep), reason='AUTOREJECT')
+    return epochs, ptp > thresholds
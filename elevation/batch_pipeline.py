@@ -0,0 +1,127 @@
+"""
+Preprocess every subject (<subject>_<block>.vhdr files) in elevation/data on a process pool:
+    python elevation/batch_pipeline.py --workers 8 --threads 1
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import pathlib
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# mne / numpy are only imported inside the workers, after their thread limits are set
+
+DIR = pathlib.Path(__file__).resolve().parent.parent
+eeg_DIR = DIR / 'elevation' / 'data'
+_thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS')
+
+
+def find_subjects(data_dir=eeg_DIR):
+    """ {subject: [block .vhdr files sorted by block number]} for all <subject>_<block>.vhdr files """
+    subjects = {}
+    for vhdr in pathlib.Path(data_dir).glob('*.vhdr'):
+        match = re.fullmatch(r'(.+)_(\d+)\.vhdr', vhdr.name)
+        if match:
+            subjects.setdefault(match[1], []).append((int(match[2]), vhdr))
+    return {subj: [vhdr for _, vhdr in sorted(blocks)] for subj, blocks in sorted(subjects.items())}
+
+
+@contextlib.contextmanager
+def _thread_limits(n_threads):
+    # set before spawning: an initializer would run after the workers may have imported numpy
+    saved = {var: os.environ.get(var) for var in _thread_vars}
+    os.environ.update({var: str(n_threads) for var in _thread_vars})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def process_subject(subj_name, vhdr_files, data_dir=eeg_DIR, cache_dir=None, params=None, profile_log=None):
+    """ preprocess all blocks of one subject, save <subject>-epo.fif and add it to the epoch store """
+    import mne
+    from pipeline_cache import preprocessing_chain
+    from ica_tools import fit_ica, find_blink_components, apply_ica
+    from epoch_store import EpochStore
+    from profiling import configure, stage
+    mne.set_log_level('warning')
+    configure(profile_log, subj_name, enabled=profile_log is not None)
+    params = params or {}
+    cache_dir = cache_dir or pathlib.Path(data_dir) / 'cache'
+    blocks = [preprocessing_chain(vhdr, cache_dir, **params)['referenced'].get() for vhdr in vhdr_files]
+    with stage('concatenate') as record:
+        epochs = record.output(mne.concatenate_epochs(blocks) if len(blocks) > 1 else blocks[0])
+    # ICA with automatic blink component selection
+    ica = fit_ica(epochs, n_components=0.99, method="fastica", cache_dir=cache_dir, name=subj_name)
+    ica.exclude = find_blink_components(ica, epochs)
+    apply_ica(epochs, ica)
+    fname = pathlib.Path(data_dir) / str(subj_name + '-epo.fif')
+    with stage('save') as record:
+        record.input(epochs)
+        epochs.save(fname, overwrite=True)  # save preprocessed data
+    EpochStore(pathlib.Path(data_dir) / 'epoch_store').add_epochs(subj_name, epochs)  # reports its own stage
+    return dict(n_blocks=len(vhdr_files), n_epochs=len(epochs), ica_exclude=ica.exclude, file=str(fname))
+
+
+def _run(subj_name, vhdr_files, data_dir, cache_dir, params, profile_log):
+    start = time.perf_counter()
+    try:
+        summary = dict(status='ok', **process_subject(subj_name, vhdr_files, data_dir, cache_dir, params,
+                                                      profile_log))
+    except Exception as error:
+        summary = dict(status='failed', error=repr(error), traceback=traceback.format_exc())
+    summary['duration'] = time.perf_counter() - start
+    return subj_name, summary
+
+
+def run_batch(data_dir=eeg_DIR, subjects=None, n_workers=None, n_threads=1, cache_dir=None, params=None,
+              summary_file='batch_summary.json', profile_log=None):
+    """
+    process the subjects on n_workers processes with n_threads BLAS / FFT threads each;
+    returns the per-subject summary (also written to data_dir / summary_file)
+    """
+    found = find_subjects(data_dir)
+    if subjects is not None:
+        found = {subj: blocks for subj, blocks in found.items() if subj in subjects}
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // n_threads)
+    results = {}
+    with _thread_limits(n_threads), ProcessPoolExecutor(max_workers=n_workers,
+                                                        mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_run, subj, blocks, data_dir, cache_dir, params, profile_log)
+                   for subj, blocks in found.items()]
+        for future in as_completed(futures):
+            subj_name, summary = future.result()
+            results[subj_name] = summary
+            print(f"{subj_name}: {summary['status']} ({summary['duration']:.1f} s)")
+    results = dict(sorted(results.items()))
+    if summary_file is not None:
+        with open(pathlib.Path(data_dir) / summary_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='preprocess all elevation subjects in parallel')
+    parser.add_argument('--data-dir', type=pathlib.Path, default=eeg_DIR)
+    parser.add_argument('--subjects', nargs='*', help='only process these subjects')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='BLAS / FFT threads per worker')
+    parser.add_argument('--profile', type=pathlib.Path, nargs='?', const='run_log.jsonl',
+                        help='append time / memory per stage to this run log (in data-dir if relative)')
+    args = parser.parse_args()
+    profile_log = args.data_dir / args.profile if args.profile is not None else None
+    results = run_batch(args.data_dir, args.subjects, args.workers, args.threads, profile_log=profile_log)
+    n_failed = sum(summary['status'] != 'ok' for summary in results.values())
+    print(f'{len(results) - n_failed} subjects processed, {n_failed} failed')
+    if profile_log is not None:
+        from profiling import aggregate, read_run_log, report
+        print(report(aggregate(read_run_log(profile_log))))
@@ -0,0 +1,299 @@
+"""
+Benchmark of the elevation pipeline on synthetic recordings, so changes can be timed without subject data:
+    python elevation/benchmark.py --minutes 6 30 --sfreq 500 1000 --workers 1 4
+    python elevation/benchmark.py --compare elevation/benchmark_results/<earlier run>.json
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import mne
+import numpy as np
+import scipy
+from scipy.signal import lfilter
+from batch_pipeline import run_batch
+from brainvision_io import BrainVisionMemmap, read_events, write_brainvision
+from cluster_stats import deviant_clusters
+from epoch_store import EpochStore
+from filtering import filter_decimate_raw
+from group_erp import ERPAccumulator
+from ica_tools import fit_ica
+from montage_registry import default_registry
+from oddball import oddball_sequence
+from pipeline_cache import event_id
+from rejection import apply_rejection
+from tf_tools import event_locked_power
+
+DIR = pathlib.Path(__file__).resolve().parent.parent
+mapping_path = DIR / 'channel_mapping.pkl'
+montage_path = DIR / 'AS-96_REF_c.bvef'
+recording_stages = ('load', 'load_memmap', 'events', 'filter', 'filter_decimate', 'epochs', 'rejection', 'ica',
+                    'tf')
+group_stages = ('batch', 'group_erp', 'cluster')
+# pink noise filter (Julius O. Smith's 3-pole / 3-zero IIR approximation, -10 dB / decade)
+_pink_b = np.array([0.049922035, -0.095993537, 0.050612699, -0.004408786])
+_pink_a = np.array([1, -2.494956002, 2.017265875, -0.522189400])
+_pink_gain = np.sqrt(np.sum(lfilter(_pink_b, _pink_a, np.eye(1, 2 ** 16)[0]) ** 2))
+
+
+def _pattern(pos, centre, width, ref):
+    # gaussian scalp distribution, as measured against the reference electrode
+    def gaussian(p):
+        return np.exp(-np.sum((p - centre) ** 2, axis=-1) / (2 * width ** 2))
+    return gaussian(pos) - gaussian(ref)
+
+
+def _erp_waveform(t, code, mmn):
+    # N1 and P2 for every sound, a mismatch negativity for the deviants
+    erp = -2e-6 * np.exp(-(t - 0.1) ** 2 / (2 * 0.02 ** 2)) + 1.5e-6 * np.exp(-(t - 0.18) ** 2 / (2 * 0.03 ** 2))
+    if code != 5:
+        erp -= mmn * (1. if code in (1, 2) else 0.8) * np.exp(-(t - 0.17) ** 2 / (2 * 0.035 ** 2))
+    return erp
+
+
+def synthetic_recording(vhdr_path, minutes=6, sfreq=500, seed=0, soa=0.6, noise=10e-6, line_noise=1e-6,
+                        blink_rate=0.2, blink_amplitude=100e-6, mmn=3e-6, n_sources=8, block_seconds=10):
+    """
+    write a seeded synthetic oddball recording (pink noise, line noise, blinks, N1 / P2 / MMN) as BrainVision
+    files with the channels of channel_mapping.pkl against FCz, in blocks; returns its events
+    """
+    rng = np.random.default_rng(seed)
+    mapping, montage = default_registry.mapping(mapping_path), default_registry.montage(montage_path)
+    ch_names = list(mapping)  # names as stored by the amplifier
+    pos = montage.pos[[montage.names.index(mapping[name]) for name in ch_names]]
+    ref = montage.pos[montage.names.index('FCz')]
+    frontal = montage.pos[[montage.names.index(ch) for ch in ('Fp1', 'Fp2')]].mean(axis=0)
+    n_samples, n_channels = int(minutes * 60 * sfreq), len(ch_names)
+    # stimuli every soa seconds (+ up to 1 sample jitter), starting after 1 s
+    codes = oddball_sequence(int((minutes * 60 - 2) / soa), deviant_freq=0.2, seed=rng)
+    onsets = (sfreq * (1 + soa * np.arange(len(codes)))).astype(np.int64) + rng.integers(0, 2, len(codes))
+    events = np.column_stack([onsets, np.zeros_like(onsets), codes])
+    t = np.arange(int(0.5 * sfreq)) / sfreq
+    erp_pattern = _pattern(pos, ref + [0, 0.01, 0], 0.06, ref)
+    templates = {code: np.outer(erp_pattern, _erp_waveform(t, code, mmn)) for code in np.unique(codes)}
+    blink_pattern = _pattern(pos, frontal, 0.05, ref)
+    blink_shape = np.hanning(int(0.3 * sfreq))
+    blink_onsets = np.sort(rng.integers(0, n_samples - len(blink_shape), rng.poisson(blink_rate * n_samples / sfreq)))
+    blink_amplitudes = blink_amplitude * rng.uniform(0.7, 1.3, len(blink_onsets))
+    mixing = rng.standard_normal((n_channels, n_sources)) / np.sqrt(n_sources)
+    line_phase = rng.uniform(0, 2 * np.pi, n_channels)
+
+    def blocks():
+        zi = np.zeros((n_channels + n_sources, len(_pink_a) - 1))
+        block_size = int(block_seconds * sfreq)
+        for start in range(0, n_samples, block_size):
+            stop = min(start + block_size, n_samples)
+            pink, zi = lfilter(_pink_b, _pink_a, rng.standard_normal((n_channels + n_sources, stop - start)),
+                               axis=1, zi=zi)
+            data = noise / (np.sqrt(2) * _pink_gain) * (pink[:n_channels] + mixing @ pink[n_channels:])
+            data += line_noise * np.sin(2 * np.pi * 50 * np.arange(start, stop) / sfreq + line_phase[:, None])
+            # responses and blinks that overlap the block
+            for i in range(*np.searchsorted(onsets, [start - len(t) + 1, stop])):
+                lo, hi = max(onsets[i], start), min(onsets[i] + len(t), stop)
+                data[:, lo - start:hi - start] += templates[codes[i]][:, lo - onsets[i]:hi - onsets[i]]
+            for i in range(*np.searchsorted(blink_onsets, [start - len(blink_shape) + 1, stop])):
+                lo, hi = max(blink_onsets[i], start), min(blink_onsets[i] + len(blink_shape), stop)
+                data[:, lo - start:hi - start] += np.outer(blink_amplitudes[i] * blink_pattern,
+                                                           blink_shape[lo - blink_onsets[i]:hi - blink_onsets[i]])
+            yield data
+
+    write_brainvision(vhdr_path, blocks(), sfreq, ch_names, events)
+    return events
+
+
+def synthetic_dataset(data_dir, n_subjects=8, minutes=6, sfreq=500, seed=0, **kwargs):
+    """ .vhdr files of n_subjects synthetic recordings (seeds seed + i), reused if made with the same parameters """
+    data_dir = pathlib.Path(data_dir)
+    params = dict(minutes=minutes, sfreq=sfreq, seed=seed, **kwargs)
+    files = [data_dir / f'synthetic{i}_1.vhdr' for i in range(n_subjects)]
+    params_file = data_dir / 'synthetic.json'
+    stored = json.loads(params_file.read_text()) if params_file.exists() else {}
+    if stored.get('params') != params:
+        stored = dict(params=params, subjects=[])
+        shutil.rmtree(data_dir / 'epoch_store', ignore_errors=True)  # preprocessed from other recordings
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for i, vhdr in enumerate(files):
+        if vhdr.name not in stored['subjects'] or not vhdr.with_suffix('.eeg').exists():
+            synthetic_recording(vhdr, minutes, sfreq, seed + i, **kwargs)
+            stored['subjects'].append(vhdr.name)
+            params_file.write_text(json.dumps(stored, indent=2))
+    return files
+
+
+def _timed(func, repeats=1):
+    """ (durations of repeats calls in seconds, result of the last call) """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def _load(vhdr):
+    # the load stage of pipeline_cache: read, rename, add the reference channel, set the montage
+    raw = mne.io.read_raw_brainvision(vhdr, preload=True, verbose='error')
+    raw.rename_channels(default_registry.mapping(mapping_path))
+    raw = mne.add_reference_channels(raw, 'FCz', copy=False)
+    raw.set_montage(default_registry.montage(montage_path).to_mne())
+    return raw
+
+
+def benchmark_recording(vhdr, stages=recording_stages, repeats=3, sfreq_new=250, tf_channel='Cz'):
+    """ {stage: durations} of the single-recording stages on one recording """
+    results = {}
+
+    def run(stage, func, n=repeats):
+        if stage in stages:
+            results[stage], result = _timed(func, n)
+            return result
+        return func() if stage in ('load', 'events', 'filter', 'epochs') else None
+
+    raw = run('load', lambda: _load(vhdr))
+    run('load_memmap', lambda: BrainVisionMemmap(vhdr, default_registry.mapping(mapping_path)).get_data(
+        dtype=np.float32))
+    events = run('events', lambda: read_events(vhdr, event_id))
+    filtered = run('filter', lambda: raw.copy().filter(l_freq=0.5, h_freq=40, verbose='error'))
+    if sfreq_new < raw.info['sfreq']:
+        run('filter_decimate', lambda: filter_decimate_raw(raw, 0.5, 40, sfreq_new))
+    epochs = run('epochs', lambda: mne.Epochs(filtered, events, event_id, tmin=-0.2, tmax=0.4, baseline=(None, 0),
+                                              reject_by_annotation=False, preload=True, verbose='error'))
+    run('rejection', lambda: apply_rejection(epochs.copy(), 200e-6, 2e-6, ('FCz',), 0.2))
+    run('ica', lambda: fit_ica(epochs, n_components=0.99, method='fastica'), n=1)
+    # the settings of TF_analysis.py: 2-20 Hz, 3-10 cycles, one channel around all stimuli
+    frex, n_cycles = np.logspace(np.log10(2), np.log10(20), 19), np.logspace(np.log10(3), np.log10(10), 19)
+    run('tf', lambda: event_locked_power(filtered.get_data(picks=tf_channel)[0], events[:, 0],
+                                         filtered.info['sfreq'], frex, n_cycles, -0.2, 0.3))
+    return results
+
+
+def benchmark_group(data_dir, workers=(1,), stages=group_stages, repeats=1, n_permutations=1000, subjects=None):
+    """ {(stage, workers): durations} of the batch preprocessing (empty cache), group ERPs and cluster tests """
+    results = {}
+    for n_workers in workers:
+        if 'batch' in stages or not (pathlib.Path(data_dir) / 'epoch_store').exists():
+            def batch():
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    run_batch(data_dir, subjects, n_workers, cache_dir=cache_dir, summary_file=None)
+            times, _ = _timed(batch, repeats)
+            if 'batch' in stages:
+                results[('batch', n_workers)] = times
+    store = EpochStore(pathlib.Path(data_dir) / 'epoch_store')
+    erps = None
+    if 'group_erp' in stages or 'cluster' in stages:
+        def group_erp():
+            accumulator = ERPAccumulator(event_id, standard='front')
+            accumulator.add_store(store, subjects)
+            return accumulator
+        times, erps = _timed(group_erp, repeats)
+        if 'group_erp' in stages:
+            results[('group_erp', 1)] = times
+    if 'cluster' in stages:
+        for n_workers in workers:
+            results[('cluster', n_workers)], _ = _timed(
+                lambda: deviant_clusters(erps, n_permutations=n_permutations, n_jobs=n_workers), repeats)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_info():
+    return dict(host=platform.node(), platform=platform.platform(), processor=platform.processor(),
+                cpu_count=os.cpu_count(), python=platform.python_version(), numpy=np.__version__,
+                scipy=scipy.__version__, mne=mne.__version__, commit=_git_commit())
+
+
+def _row(stage, minutes, sfreq, workers, n_subjects, times):
+    return dict(stage=stage, minutes=minutes, sfreq=sfreq, workers=workers, n_subjects=n_subjects, times=times,
+                best=min(times), median=float(np.median(times)))
+
+
+def run_benchmark(data_dir, minutes=(6,), sfreq=(500,), workers=(1,), n_subjects=8, stages=None, repeats=3,
+                  seed=0, n_permutations=1000, out=None):
+    """ time the stages on synthetic data of every size (minutes x sfreq) and write the results to out """
+    stages = stages or recording_stages + group_stages
+    results = dict(meta=dict(started=datetime.datetime.now().isoformat(timespec='seconds'), **machine_info(),
+                             params=dict(minutes=list(minutes), sfreq=list(sfreq), workers=list(workers),
+                                         n_subjects=n_subjects, repeats=repeats, seed=seed,
+                                         n_permutations=n_permutations)),
+                   results=[])
+    for size_minutes in minutes:
+        for size_sfreq in sfreq:
+            size_dir = pathlib.Path(data_dir) / f'{size_minutes:g}min_{size_sfreq:g}Hz'
+            n = n_subjects if set(stages) & set(group_stages) else 1
+            files = synthetic_dataset(size_dir, n, size_minutes, size_sfreq, seed)
+            print(f'{size_minutes:g} min, {size_sfreq:g} Hz:')
+            for stage, times in benchmark_recording(files[0], stages, repeats).items():
+                results['results'].append(_row(stage, size_minutes, size_sfreq, 1, 1, times))
+                print(f'  {stage:>16}: {min(times):8.3f} s')
+            group = benchmark_group(size_dir, workers, stages, 1, n_permutations,
+                                    [vhdr.stem.rsplit('_', 1)[0] for vhdr in files])
+            for (stage, n_workers), times in group.items():
+                results['results'].append(_row(stage, size_minutes, size_sfreq, n_workers, n, times))
+                print(f'  {stage:>16}: {min(times):8.3f} s ({n_workers} workers, {n} subjects)')
+    if out is not None:
+        out = pathlib.Path(out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(results, indent=2))
+    return results
+
+
+def compare(old, new, tolerance=0.1):
+    """ best times of two result files stage by stage, 'slower' / 'faster' beyond 1 +- tolerance """
+    old, new = [json.loads(pathlib.Path(r).read_text()) if not isinstance(r, dict) else r for r in (old, new)]
+
+    def key(row):
+        return row['stage'], row['minutes'], row['sfreq'], row['workers']
+
+    old_best = {key(row): row['best'] for row in old['results']}
+    rows = []
+    for row in new['results']:
+        if key(row) in old_best:
+            ratio = row['best'] / old_best[key(row)]
+            change = 'slower' if ratio > 1 + tolerance else 'faster' if ratio < 1 - tolerance else 'same'
+            rows.append(dict(zip(('stage', 'minutes', 'sfreq', 'workers'), key(row)), old=old_best[key(row)],
+                             new=row['best'], ratio=ratio, change=change))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the elevation pipeline on synthetic recordings')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[6], help='recording lengths (6-60 min)')
+    parser.add_argument('--sfreq', type=float, nargs='+', default=[500], help='sampling rates (500 / 1000 Hz)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1], help='worker counts for batch / cluster')
+    parser.add_argument('--subjects', type=int, default=8, help='synthetic subjects for the group stages')
+    parser.add_argument('--stages', nargs='+', choices=recording_stages + group_stages, help='default: all')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--permutations', type=int, default=1000)
+    parser.add_argument('--data-dir', type=pathlib.Path, default=DIR / 'elevation' / 'benchmark_data')
+    parser.add_argument('--out', type=pathlib.Path, help='result file (default: benchmark_results/<time>.json)')
+    parser.add_argument('--compare', type=pathlib.Path, help='earlier result file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as slower')
+    args = parser.parse_args()
+    mne.set_log_level('warning')
+    out = args.out or DIR / 'elevation' / 'benchmark_results' / \
+        f'{datetime.datetime.now():%Y-%m-%d_%H%M%S}.json'
+    results = run_benchmark(args.data_dir, args.minutes, args.sfreq, args.workers, args.subjects, args.stages,
+                            args.repeats, args.seed, args.permutations, out)
+    print(f'results written to {out}')
+    if args.compare is not None:
+        rows = compare(args.compare, results, args.tolerance)
+        for row in rows:
+            print(f"{row['stage']:>16} {row['minutes']:g} min {row['sfreq']:g} Hz {row['workers']} workers: "
+                  f"{row['old']:.3f} -> {row['new']:.3f} s ({row['ratio']:.2f}x) {row['change']}")
+        if any(row['change'] == 'slower' for row in rows):
+            sys.exit(1)
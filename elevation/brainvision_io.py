@@ -0,0 +1,199 @@
+"""
+BrainVision recordings (.vhdr / .vmrk / .eeg) without loading them into memory:
+    rec = BrainVisionMemmap(eeg_DIR / 'Vanessa_1.vhdr', mapping=mapping)
+    fcz = rec.get_data('FCz', tmin=10, tmax=70, dtype=np.float32)  # one channel, one minute
+    events = read_events(eeg_DIR / 'Vanessa_1.vhdr', event_id)  # from the .vmrk only
+"""
+import configparser
+import pathlib
+import re
+import warnings
+import numpy as np
+
+_formats = dict(INT_16='<i2', INT_32='<i4', IEEE_FLOAT_32='<f4')
+_marker = re.compile(rb'^Mk\d+=([^,\r\n]*),([^,\r\n]*),(\d+),(\d+)', re.M)  # type, description, position, size
+_units = {'V': 1., 'mV': 1e-3, 'µV': 1e-6, 'uV': 1e-6, 'μV': 1e-6, 'nV': 1e-9}
+
+
+def read_vhdr(vhdr_path):
+    """ parse a BrainVision header into a configparser object (section names as in the file) """
+    vhdr_path = pathlib.Path(vhdr_path)
+    raw_text = vhdr_path.read_bytes()
+    codepage = 'utf-8' if b'Codepage=UTF-8' in raw_text else 'latin-1'
+    text = raw_text.decode(codepage).lstrip('\ufeff')
+    text = text[text.index('['):]  # skip the identification line
+    header = configparser.ConfigParser(interpolation=None, comment_prefixes=(';',), strict=False)
+    header.optionxform = str  # keep the case of keys (Ch1, DataFile, ...)
+    header.read_string(text)
+    return header
+
+
+class BrainVisionMemmap:
+    """ memory-mapped BrainVision recording; mapping (e.g. channel_mapping.pkl) renames channels """
+
+    def __init__(self, vhdr_path, mapping=None):
+        self.vhdr_path = pathlib.Path(vhdr_path)
+        header = read_vhdr(self.vhdr_path)
+        common, binary = header['Common Infos'], header['Binary Infos']
+        if common.get('DataFormat', 'BINARY').upper() != 'BINARY':
+            raise ValueError('only binary BrainVision data files can be memory-mapped')
+        self.data_file = self.vhdr_path.parent / common['DataFile']
+        self.marker_file = self.vhdr_path.parent / common['MarkerFile'] if 'MarkerFile' in common else None
+        self.sfreq = 1e6 / float(common['SamplingInterval'])
+        n_channels = int(common['NumberOfChannels'])
+        self.binary_format = binary['BinaryFormat']
+        self.orientation = common.get('DataOrientation', 'MULTIPLEXED').upper()
+        names, scales = [], []
+        for ch in range(1, n_channels + 1):
+            fields = header['Channel Infos'][f'Ch{ch}'].split(',')
+            name = fields[0].replace('\\1', ',')
+            resolution = float(fields[2]) if len(fields) > 2 and fields[2] else 1.
+            unit = fields[3] if len(fields) > 3 and fields[3] else 'µV'
+            names.append(mapping.get(name, name) if mapping else name)
+            scales.append(resolution * _units.get(unit, 1e-6))
+        self.ch_names = names
+        self.scales = np.array(scales)  # factor from stored values to volts
+        dtype = np.dtype(_formats[self.binary_format])
+        n_samples = self.data_file.stat().st_size // (dtype.itemsize * n_channels)
+        shape = (n_samples, n_channels) if self.orientation == 'MULTIPLEXED' else (n_channels, n_samples)
+        self._memmap = np.memmap(self.data_file, dtype=dtype, mode='r', shape=shape)
+
+    @property
+    def n_samples(self):
+        return self._memmap.shape[0] if self.orientation == 'MULTIPLEXED' else self._memmap.shape[1]
+
+    @property
+    def n_channels(self):
+        return len(self.ch_names)
+
+    @property
+    def times(self):
+        return np.arange(self.n_samples) / self.sfreq
+
+    def picks(self, picks=None):
+        """ channel indices for None (all), a name, an index or a list of names / indices """
+        if picks is None:
+            return np.arange(self.n_channels)
+        if isinstance(picks, (str, int, np.integer)):
+            picks = [picks]
+        return np.array([self.ch_names.index(ch) if isinstance(ch, str) else int(ch) for ch in picks])
+
+    def _samples(self, start, stop, tmin, tmax):
+        if tmin is not None:
+            start = int(round(tmin * self.sfreq))
+        if tmax is not None:
+            stop = int(round(tmax * self.sfreq))
+        return max(start, 0), min(self.n_samples if stop is None else stop, self.n_samples)
+
+    def view(self, picks=None, start=0, stop=None, tmin=None, tmax=None):
+        """ stored (unscaled) values as (channels x samples), a view for contiguous channels """
+        start, stop = self._samples(start, stop, tmin, tmax)
+        data = self._memmap[start:stop].T if self.orientation == 'MULTIPLEXED' else self._memmap[:, start:stop]
+        idx = self.picks(picks)
+        if len(idx) and np.all(np.diff(idx) == 1):
+            return data[idx[0]:idx[-1] + 1]
+        return data[idx]
+
+    def get_data(self, picks=None, start=0, stop=None, tmin=None, tmax=None, dtype=np.float64):
+        """ selected channels and samples in volts as (channels x samples), converted to dtype """
+        data = self.view(picks, start, stop, tmin, tmax)
+        return data.astype(dtype) * self.scales[self.picks(picks), None].astype(dtype)
+
+    def get_epochs(self, onsets, tmin, tmax, picks=None, dtype=np.float64):
+        """ windows [onset + int(sfreq * tmin), onset + int(sfreq * tmax)) in volts, events x channels x times """
+        idx = self.picks(picks)
+        onsets = np.asarray(onsets, dtype=np.int64)
+        rel = np.arange(int(self.sfreq * tmin), int(self.sfreq * tmax))
+        samples = onsets[:, None] + rel
+        if len(samples) and (samples.min() < 0 or samples.max() >= self.n_samples):
+            raise ValueError('epoch window exceeds the recording for at least one event')
+        if self.orientation == 'MULTIPLEXED':
+            data = self._memmap[samples][..., idx].transpose(0, 2, 1)  # events x channels x times
+        else:
+            data = self._memmap[idx[:, None, None], samples].transpose(1, 0, 2)
+        return data.astype(dtype) * self.scales[idx, None].astype(dtype)
+
+
+def _sfreq(vhdr_path):
+    return 1e6 / float(read_vhdr(vhdr_path)['Common Infos']['SamplingInterval'])
+
+
+def read_markers(vmrk_path):
+    """ types, descriptions, 0-based positions and lengths of all markers of a .vmrk file """
+    markers = _marker.findall(pathlib.Path(vmrk_path).read_bytes())
+    if not markers:
+        empty = np.zeros(0, dtype=np.int64)
+        return np.array([], dtype=str), np.array([], dtype=str), empty, empty
+    types, descriptions, positions, lengths = np.array(markers).T
+    return (np.char.decode(types, 'latin-1'), np.char.decode(descriptions, 'latin-1'),
+            positions.astype(np.int64) - 1, lengths.astype(np.int64))
+
+
+def read_events(path, event_id=None, latency=0., sfreq=None, marker_type='Stimulus', on_unknown='raise'):
+    """
+    mne events of the marker_type markers of a .vhdr / .vmrk; codes not in event_id raise ('raise'), warn ('warn')
+    or are dropped ('ignore'). latency: seconds added to every event (a number or one per event).
+    """
+    path = pathlib.Path(path)
+    if path.suffix.lower() == '.vhdr':
+        common = read_vhdr(path)['Common Infos']
+        vmrk_path, sfreq = path.parent / common['MarkerFile'], sfreq or 1e6 / float(common['SamplingInterval'])
+    else:
+        vmrk_path = path
+    types, descriptions, samples, _ = read_markers(vmrk_path)
+    keep = types == marker_type
+    codes = np.char.lstrip(descriptions[keep], 'SR ')
+    events = np.zeros((keep.sum(), 3), dtype=np.int64)
+    events[:, 0] = samples[keep]
+    events[:, 2] = codes.astype(np.int64) if len(codes) else 0
+    latency = np.asarray(latency, dtype=float)
+    if np.any(latency):
+        if latency.ndim and len(latency) != len(events):
+            raise ValueError(f'{len(latency)} latencies for {len(events)} events')
+        sfreq = sfreq or _sfreq(vmrk_path.with_suffix('.vhdr'))
+        events[:, 0] += np.round(latency * sfreq).astype(np.int64)
+    if event_id is not None:
+        known = np.isin(events[:, 2], list(event_id.values()))
+        if not known.all():
+            unknown = {int(code): int(n) for code, n in zip(*np.unique(events[~known, 2], return_counts=True))}
+            message = f'{vmrk_path.name}: trigger codes not in event_id {event_id} (code: count): {unknown}'
+            if on_unknown == 'raise':
+                raise ValueError(message)
+            elif on_unknown == 'warn':
+                warnings.warn(message)
+            events = events[known]
+        missing = [name for name, code in event_id.items() if code not in events[:, 2]]
+        if missing:
+            warnings.warn(f'{vmrk_path.name}: no events for {missing}')
+    return events
+
+
+def write_brainvision(vhdr_path, blocks, sfreq, ch_names, events=(), resolution=0.1, binary_format='INT_16'):
+    """
+    write a multiplexed BrainVision triplet from a (channels x samples) array or an iterable of such blocks
+    in volts; resolution in µV per stored unit, events as Stimulus markers 'S  <code>'
+    """
+    vhdr_path = pathlib.Path(vhdr_path)
+    eeg_path, vmrk_path = vhdr_path.with_suffix('.eeg'), vhdr_path.with_suffix('.vmrk')
+    if isinstance(blocks, np.ndarray):
+        blocks = [blocks]
+    channels = ''.join(f'Ch{i}={name.replace(",", chr(92) + "1")},,{resolution:g},µV\n'
+                       for i, name in enumerate(ch_names, 1))
+    vhdr_path.write_text('Brain Vision Data Exchange Header File Version 1.0\n\n[Common Infos]\nCodepage=UTF-8\n'
+                         f'DataFile={eeg_path.name}\nMarkerFile={vmrk_path.name}\nDataFormat=BINARY\n'
+                         f'DataOrientation=MULTIPLEXED\nNumberOfChannels={len(ch_names)}\n'
+                         f'SamplingInterval={1e6 / sfreq:g}\n\n[Binary Infos]\nBinaryFormat={binary_format}\n\n'
+                         f'[Channel Infos]\n{channels}', encoding='utf-8')
+    dtype = np.dtype(_formats[binary_format])
+    with open(eeg_path, 'wb') as f:
+        for block in blocks:
+            values = np.asarray(block).T / (resolution * 1e-6)
+            if dtype.kind == 'i':
+                info = np.iinfo(dtype)
+                values = np.clip(np.round(values), info.min, info.max)
+            f.write(values.astype(dtype).tobytes())
+    markers = ''.join(f'Mk{i}=Stimulus,S{int(code):>3},{int(sample) + 1},1,0\n'
+                      for i, (sample, _, code) in enumerate(np.asarray(events).reshape(-1, 3), 2))
+    vmrk_path.write_text('Brain Vision Data Exchange Marker File, Version 1.0\n\n[Common Infos]\nCodepage=UTF-8\n'
+                         f'DataFile={eeg_path.name}\n\n[Marker Infos]\nMk1=New Segment,,1,1,0,00000000000000000000\n'
+                         f'{markers}', encoding='utf-8')
@@ -0,0 +1,144 @@
+"""
+Spatio-temporal cluster permutation tests (Maris & Oostenveld 2007) of deviant - standard difference waves:
+    results = deviant_clusters(erps, n_permutations=10000, n_jobs=8)  # erps: group_erp.ERPAccumulator
+    results['left'].significant()
+"""
+import functools
+import itertools
+import pathlib
+import mne
+import numpy as np
+from scipy import sparse, stats
+from scipy.sparse.csgraph import connected_components
+from montage_registry import default_registry
+from worker_pool import map_tasks, shared, worker_pool
+
+DIR = pathlib.Path(__file__).resolve().parent.parent
+montage_path = DIR / 'AS-96_REF_c.bvef'
+
+@functools.lru_cache(maxsize=8)
+def _channel_adjacency(ch_names, montage_path):
+    montage = default_registry.montage(montage_path).to_mne()
+    info = mne.create_info(list(ch_names), 1000., 'eeg')
+    info.set_montage(montage, on_missing='raise', verbose='error')
+    with mne.utils.use_log_level('error'):
+        adjacency, _ = mne.channels.find_ch_adjacency(info, 'eeg')
+    return adjacency.tocsr()
+
+
+def channel_adjacency(ch_names, montage_path=montage_path):
+    """ sparse channel adjacency from the montage positions (as mne.channels.find_ch_adjacency), cached """
+    return _channel_adjacency(tuple(ch_names), str(montage_path))
+
+
+def spatiotemporal_edges(adjacency, n_times):
+    """ edges (two index arrays) of the channels x times graph, node ch * n_times + t """
+    rows, cols = sparse.triu(adjacency, k=1).nonzero()
+    t = np.arange(n_times)
+    spatial = (rows[:, None] * n_times + t).ravel(), (cols[:, None] * n_times + t).ravel()
+    ch = np.arange(adjacency.shape[0])[:, None] * n_times
+    temporal = (ch + t[:-1]).ravel(), (ch + t[1:]).ravel()
+    return np.concatenate([spatial[0], temporal[0]]), np.concatenate([spatial[1], temporal[1]])
+
+
+def t_maps(data, signs):
+    """ one-sample t-values of data (subjects x nodes) for every row of signs (permutations x subjects) """
+    n = data.shape[0]
+    mean = signs @ data / n
+    var = ((data ** 2).sum(axis=0) - n * mean ** 2) / (n - 1)
+    return mean / np.sqrt(np.maximum(var, np.finfo(float).tiny) / n)
+
+
+def cluster_masses(t, threshold, edges):
+    """ (cluster label per node, -1 outside clusters, t-sum per cluster) of the same-sign |t| > threshold nodes """
+    pos, neg = t > threshold, t < -threshold
+    supra = pos | neg
+    if not supra.any():
+        return np.full(len(t), -1), np.zeros(0)
+    i, j = edges
+    keep = (pos[i] & pos[j]) | (neg[i] & neg[j])
+    graph = sparse.coo_matrix((np.ones(keep.sum(), dtype=bool), (i[keep], j[keep])), shape=(len(t), len(t)))
+    _, labels = connected_components(graph, directed=False)
+    # renumber so that only supra-threshold nodes get a cluster
+    _, labels[supra] = np.unique(labels[supra], return_inverse=True)
+    labels[~supra] = -1
+    return labels, np.bincount(labels[supra], weights=t[supra])
+
+
+def _null_block(seed, n, block_signs=None):
+    """ largest absolute cluster mass of n random sign-flip permutations (or of the given sign rows) """
+    data, threshold, edges = shared['data'], shared['threshold'], shared['edges']
+    if block_signs is None:
+        block_signs = np.random.default_rng(seed).choice([-1., 1.], size=(n, data.shape[0]))
+    h0 = np.zeros(len(block_signs))
+    for k, t in enumerate(t_maps(data, block_signs)):
+        masses = cluster_masses(t, threshold, edges)[1]
+        h0[k] = np.abs(masses).max() if len(masses) else 0.
+    return h0
+
+
+class ClusterResult:
+    """ result of cluster_test: observed t-map, cluster masks, masses, p-values and the null distribution h0 """
+
+    def __init__(self, t_obs, clusters, masses, p_values, h0, ch_names=None, times=None):
+        self.t_obs, self.clusters, self.masses, self.p_values, self.h0 = t_obs, clusters, masses, p_values, h0
+        self.ch_names, self.times = ch_names, times
+
+    def significant(self, alpha=0.05):
+        """ indices of the clusters with p < alpha """
+        return np.flatnonzero(self.p_values < alpha)
+
+    def mask(self, alpha=0.05):
+        """ (channels x times) mask of all significant clusters, e.g. for Evoked.plot_image(mask=...) """
+        mask = np.zeros(self.t_obs.shape, dtype=bool)
+        for k in self.significant(alpha):
+            mask |= self.clusters[k]
+        return mask
+
+
+def cluster_test(data, adjacency, n_permutations=10000, threshold=None, p_threshold=0.05, seed=42,
+                 n_jobs=1, block_size=250):
+    """
+    two-tailed sign-flip cluster test of data (subjects x channels x times) against zero, all sign patterns if
+    there are few subjects; blocks of block_size permutations with seeds spawned from seed run on n_jobs processes
+    """
+    data = np.asarray(data, dtype=float)
+    n_subjects, n_channels, n_times = data.shape
+    if n_subjects < 2:
+        raise ValueError('the cluster test needs at least 2 subjects')
+    if threshold is None:
+        threshold = stats.t.ppf(1 - p_threshold / 2, n_subjects - 1)
+    flat = data.reshape(n_subjects, -1)
+    edges = spatiotemporal_edges(sparse.csr_matrix(adjacency), n_times)
+    t_obs = t_maps(flat, np.ones((1, n_subjects)))[0]
+    labels, masses = cluster_masses(t_obs, threshold, edges)
+    if 2 ** n_subjects <= n_permutations:
+        # exact test: every sign pattern once (the observed one included)
+        signs = np.array(list(itertools.product([1., -1.], repeat=n_subjects)))
+        tasks = [(None, None, block) for block in np.array_split(signs, max(1, len(signs) // block_size))]
+    else:
+        n_blocks = -(-n_permutations // block_size)
+        seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+        sizes = [block_size] * (n_blocks - 1) + [n_permutations - block_size * (n_blocks - 1)]
+        tasks = [(s, n, None) for s, n in zip(seeds, sizes)]
+    with worker_pool(n_jobs if len(tasks) > 1 else 1, data=flat, threshold=threshold, edges=edges) as pool:
+        h0 = np.concatenate(map_tasks(pool, _null_block, tasks))
+    if tasks[0][0] is not None:
+        h0 = np.append(h0, np.abs(masses).max() if len(masses) else 0.)  # the observed data is one permutation
+    p_values = np.array([(h0 >= abs(mass)).mean() for mass in masses])
+    clusters = [(labels == k).reshape(n_channels, n_times) for k in range(len(masses))]
+    return ClusterResult(t_obs.reshape(n_channels, n_times), clusters, masses, p_values, h0)
+
+
+def deviant_clusters(erps, deviants=('up', 'down', 'left', 'right'), montage_path=montage_path, **kwargs):
+    """ {deviant: ClusterResult} of the subjects' deviant - standard difference waves (kwargs: cluster_test) """
+    adjacency = channel_adjacency(erps.ch_names, montage_path)
+    results = {}
+    for deviant in deviants:
+        data = np.array([averages[deviant][1] - averages[erps.standard][1]
+                         for averages in erps.subject_averages.values()
+                         if deviant in averages and erps.standard in averages])
+        result = cluster_test(data, adjacency, **kwargs)
+        result.ch_names, result.times = erps.ch_names, erps.times
+        results[deviant] = result
+    return results
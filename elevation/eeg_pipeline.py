@@ -1,6 +1,9 @@
 import mne
 import pathlib
-import pickle
+from pipeline_cache import preprocessing_chain, event_id
+from ica_tools import fit_ica, find_blink_components, apply_ica
+from epoch_store import EpochStore
+from profiling import configure, stage
 # define paths to current folders
 DIR = pathlib.Path.cwd()
 eeg_DIR = DIR / 'elevation' / "data"
@@ -8,72 +11,56 @@ import matplotlib
 matplotlib.use('TkAgg')
 # from matplotlib import pyplot as plt
 subj_name = 'Vanessa'
-
-# load raw data
-raw = mne.io.read_raw_brainvision(eeg_DIR / str(subj_name + '_1.vhdr'), preload=True)
-
-# load channel name mapping and rename channels
-with open('channel_mapping.pkl', 'rb') as f:
-    mapping = pickle.load(f)
-raw.rename_channels(mapping)
-
-# add reference channel
-raw = mne.add_reference_channels(raw, 'FCz', copy=True)
-
-# load and apply montage
-montage_path = DIR / "AS-96_REF_c.bvef"
-montage = mne.channels.read_custom_montage(fname=montage_path)
-raw.set_montage(montage)
-
-# bandpass filter raw data
-raw.filter(l_freq=0.5, h_freq=40)
-
-# load and name events
-events = mne.events_from_annotations(raw)[0]  # load events
-event_id = dict(up=1, down=2, left=3, right=4, front=5)  # assign event id's to the trigger numbers
+# enabled=True: time, memory and data size of every stage are appended to the run log,
+# summarize with python elevation/profiling.py elevation/data/run_log.jsonl
+configure(eeg_DIR / 'run_log.jsonl', subj_name, enabled=False)
 
 # set epoch times
 tmin = -0.2
 tmax = 0.4
 
-# set trial rejection parameters
+# set trial rejection parameters (FCz, the recording reference, is excluded from the flat criteria)
 reject_criteria = dict(eeg=200e-6)   # 200 µV
 flat_criteria = dict(eeg=2e-6)   # 2 µV
 
-# get epoched data with applied baseline and automatic trial rejection
-# (should not remove eye movements and blinks yet)
-raw.info['bads'] += []
-raw.interpolate_bads
-raw.info['bads'] += ['FCz']  # exclude FCz channel from flat criteria
-epochs = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax,
-                    reject=reject_criteria, flat=flat_criteria,
-                    reject_by_annotation=False, preload=True)
-epochs.info['bads'] = []
-epochs.plot_drop_log()
+# to avoid too many epochs being dropped due to a single channel, channels that exceed the
+# rejection criteria in more than this share of epochs (e.g. FC2) are interpolated instead
+bad_channel_share = 0.2  # None: plain mne rejection
 
-# # hold on
-# to avoid too many epochs being dropped due to a single channel,
-# consider removing and interpolating these channels in the raw data
-# raw.info['bads'] += ['FC2']
-# raw.interpolate_bads()
+# optionally decimate to a lower sampling rate right after the 0.5-40 Hz bandpass filter
+# (events are remapped, everything after the filter runs on the smaller data)
+sfreq_new = None  # e.g. 250
 
-# re-reference
 # reference = ['PO9', 'PO10']  # set average of both mastoid electrodes as reference
 reference = 'average'  # alternatively use avg reference
-epochs.set_eeg_reference(reference)
+
+# load raw data, rename channels, add FCz reference channel, apply montage, bandpass filter,
+# load events and get epoched data with applied baseline and automatic trial rejection
+# (should not remove eye movements and blinks yet), then re-reference.
+# every stage is cached in eeg_DIR / 'cache' and only recomputed when its parameters change
+stages = preprocessing_chain(eeg_DIR / str(subj_name + '_1.vhdr'), eeg_DIR / 'cache',
+                             l_freq=0.5, h_freq=40, event_id=event_id, tmin=tmin, tmax=tmax,
+                             reject=reject_criteria, flat=flat_criteria, flat_exclude=['FCz'],
+                             reference=reference, sfreq_new=sfreq_new, bad_channel_share=bad_channel_share)
+events = stages['events'].get()
+epochs = stages['referenced'].get()
+epochs.plot_drop_log()
 
 # ICA
-ica = mne.preprocessing.ICA(n_components=0.99, method="fastica")
-ica.fit(epochs)
-ica.plot_components()  # plot components
+# fitted on a decimated, 1 Hz high-passed copy; the fit is stored in the cache and reused by reruns
+ica = fit_ica(epochs, n_components=0.99, method="fastica", cache_dir=eeg_DIR / 'cache', name=subj_name)
+# pick blink components by their correlation with the frontal channels (Fp1, Fp2, AF7, AF8)
+ica.exclude = find_blink_components(ica, epochs)
+ica.plot_components()  # plot components, check the selection
 # ica_sources = ica.get_sources(epochs)
 # ica_sources.plot(picks="all")  # plot time trace of components
 # ica.plot_properties(epochs, picks=[0])  # take a closer look
-ica.exclude = [0]  # remove selected components
-ica.apply(epochs)  # apply ICA
+apply_ica(epochs, ica)  # apply ICA (remove selected components)
 
 # ---- here we might want to save the pre-processed epochs object
-epochs.save(eeg_DIR / str(subj_name + '-epo.fif'), overwrite=True)  # save preprocessed data
+with stage('save'):
+    epochs.save(eeg_DIR / str(subj_name + '-epo.fif'), overwrite=True)  # save preprocessed data
+EpochStore(eeg_DIR / 'epoch_store').add_epochs(subj_name, epochs)  # condition / channel slices for group analyses
 
 # read saved epochs
 epochs_v = mne.read_epochs(eeg_DIR / 'vanessa-epo.fif', proj=True, preload=True, verbose=None)
@@ -1,6 +1,8 @@
 import mne
 import pathlib
 import pickle
+from group_erp import ERPAccumulator, event_id
+from epoch_store import EpochStore
 # define paths to current folders
 DIR = pathlib.Path.cwd()
 eeg_DIR = DIR / 'elevation' / "data"
@@ -8,30 +10,34 @@ import matplotlib
 matplotlib.use('TkAgg')
 from matplotlib import pyplot as plt
 
-# load single subject preprocessed epochs
-epochs_v = mne.read_epochs(eeg_DIR / 'vanessa-epo.fif', proj=True, preload=True, verbose=None)
-epochs_l = mne.read_epochs(eeg_DIR / 'leonie-epo.fif', proj=True, preload=True, verbose=None)
-epochs_s = mne.read_epochs(eeg_DIR / 'sophie-epo.fif', proj=True, preload=True, verbose=None)
-
-# get cross subject ERPs
-epochs = mne.concatenate_epochs([epochs_l, epochs_s])
+# add single subject preprocessed epochs one at a time
+# (only running per-condition averages and variances are kept, not the epochs of all subjects)
+# the epoch store (filled by eeg_pipeline.py / batch_pipeline.py) only reads the channels and conditions used
+store = EpochStore(eeg_DIR / 'epoch_store')
+subjects = ['leonie', 'sophie']  # add 'vanessa' to include that subject
+for subj_name in subjects:
+    if subj_name not in store.subjects:  # preprocessed before the store existed
+        store.add_file(eeg_DIR / str(subj_name + '-epo.fif'))
+erps = ERPAccumulator(event_id, standard='front')
+erps.add_store(store, subjects)
 
 # look at single conditions / channels
 condition = 'front'
 channel = 'FCz'
-evoked = epochs.pick(channel)[condition].average()  # pick single channel of single condition
+evoked = erps.grand_average(condition).pick(channel)  # pick single channel of single condition
 mne.viz.plot_evoked(evoked, ylim=dict(eeg=[-1, 4]))
 evoked_data = evoked._data  # obtain data array of that channel
+evoked_sem = erps.standard_error(condition)[erps.ch_names.index(channel)]  # standard error across subjects
 
 
 # visually compare ERP of standard to deviant conditions
-deviant_condition = ['left']
-evoked_deviant = epochs[deviant_condition].average()
-evoked_standard = epochs['front'].average()
+deviant_condition = 'left'
+evoked_deviant = erps.grand_average(deviant_condition)
+evoked_standard = erps.grand_average('front')
 # plot both ERPs
 mne.viz.plot_compare_evokeds([evoked_deviant, evoked_standard], picks='FCz', ylim=dict(eeg=[-1, 4]))
-# plot difference waves
-diff = mne.combine_evoked([evoked_deviant, evoked_standard], weights=[1, -1])
+# plot difference waves (deviant - standard, averaged over subjects)
+diff = erps.difference_wave(deviant_condition)
 
 # plot distribution of difference wave
 diff.plot_joint(times=[0.05, 0.1, 0.15, 0.2])
@@ -43,7 +49,15 @@ diff.plot_topomap(times=[0.05, 0.1, 0.15, 0.2])
 
 # compare mmn rms up vs right
 # plot evoked pattern on topographic map
-epochs['up'].average().plot_joint()
+evoked_up = erps.grand_average('up')
+evoked_up.plot_joint()
 evoked_up.plot_topomap(times=[0., 0.08, 0.1, 0.12, 0.2])
 
 
+
+# cluster-based permutation tests of the difference waves of all deviants (subjects x channels x times)
+from cluster_stats import deviant_clusters
+clusters = deviant_clusters(erps, n_permutations=10000, n_jobs=1)
+for deviant, result in clusters.items():
+    print(deviant, 'significant clusters:', result.significant(), 'p =', result.p_values[result.significant()])
+    erps.difference_wave(deviant).plot_image(mask=result.mask(), titles=f'{deviant} - front')
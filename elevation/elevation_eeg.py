@@ -1,67 +1,52 @@
 import slab
-import freefield
 import numpy as np
 import os
+import pathlib
+import time
+from stimulus_scheduler import FreefieldBackend, StimulusBank, TrialScheduler, timing_summary
+from oddball import oddball_sequence, trial_list
+from trial_timing import TimingLog, TimedBackend, read_timing_log, timing_report
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 slab.set_default_samplerate(44100)
 
-# initialize processors
-freefield.initialize(setup='dome', default='play_rec')
-freefield.set_logger('warning')  # set logging output level
+# initialize processors (logging output level: warning); every processor call is timestamped into a timing log
+timing_DIR = pathlib.Path.cwd() / 'elevation' / 'data' / 'timing'
+timing_log = TimingLog(timing_DIR / time.strftime('elevation_%Y%m%d_%H%M%S.tlog'))
+backend = TimedBackend(FreefieldBackend(setup='dome', default='play_rec'), timing_log)
 
 # stimulus generation
 stim = slab.Sound.pinknoise(duration=0.1)
 stim = stim.ramp(when='both', duration=0.1)  # ramp the waveform to avoid 'click' at the end of noise
-silence = slab.Sound.silence(duration=0.5)  # add a silence for duration of ISI
-sound_seq = slab.Sound.sequence(stim, silence)  # combine the two sounds
-sound_seq.level = 85
-freefield.write(tag='playbuflen', value=sound_seq.n_samples, processors=['RX82', 'RX81', 'RP2'])
-# freefield.write(tag='playbuflen', value=sound_seq.n_samples, processors=['all'])
+stim.level = 85 + 20 * np.log10(np.sqrt(0.6 / 0.1))  # 85 dB over stimulus + 500 ms silence, as before
+# the stimulus is uploaded once, the 500 ms silence (ISI) is timed by the scheduler: onsets every 600 ms
+bank = StimulusBank(backend, n_samples_processors=['RX82', 'RX81', 'RP2'])
+bank.add('noise', stim)
+scheduler = TrialScheduler(backend, bank, soa=0.6)
 
 
 
 """ Generate trial sequence with 600 trials and deviants with 20% probability """
-# 6 minutes runtime per block of trials
-trial_seq = slab.Trialsequence(conditions=1, n_reps=167, deviant_freq=0.2)
-# todo work around; avoid shuffling 600 elements until
-#  "np.min(np.diff(np.random.choice(range(1000)), 200, replace=False))) < min_dist" is satisfied
-for i in range(2):
-    trial_seq.trials.extend(slab.Trialsequence(conditions=1, n_reps=167, deviant_freq=0.2).trials)
-trial_seq.n_remaining, trial_seq.n_trials = 600, 600  # modify class attributes
-# check that deviants don't occur twice in a row:
-if np.min(np.diff([i for i, e in enumerate(trial_seq.trials) if e == 0])) < 2:
-    print('Warning: trial sequence contains 2 deviant stimuli in a row.')
-
-
-z = 0
-for trial in trial_seq:
-    z += 1  # introduce counting variable
-    print(z)
-    if trial == 0:  # deviant trial
-        deviant = np.random.randint(1, 5)  # randomly select one out of 4 deviants from uniform distribution
-        if deviant == 1:
-            speaker_index = 20  # az: 0, ele: 37.5
-        elif deviant == 2:
-            speaker_index = 26  # az: 0, ele: -37.5
-        elif deviant == 3:
-            speaker_index = 8  # az: -35, ele: 0
-        elif deviant == 4:
-            speaker_index = 38  # az: 35, ele: 0
-        # set loudspeaker position, depending on deviant index
-        freefield.set_signal_and_speaker(signal=sound_seq, speaker=speaker_index, equalize=False)
-        # set trigger value to index of deviant stimulus
-        freefield.write(tag='trigcode', value=deviant, processors='RX82')
-    else:
-        # play from central speaker
-        freefield.set_signal_and_speaker(signal=sound_seq, speaker=23, equalize=False)
-        # set trigger value to 4 when playing standard stimulus
-        freefield.write(tag='trigcode', value=5, processors='RX82')
-    # play and wait until the sound is played before continuing with next trial (loop iteration)
-    freefield.play()
-    freefield.wait_to_finish_playing()
-    if z % 40 == 0:  # every 50 trials
-        print('\n Point laser at previous sound source and press button to continue. \n')
-        freefield.wait_for_button()
+# 6 minutes runtime per block of trials; 120 deviants (30 per speaker), never two deviants in a row
+seed = np.random.SeedSequence().entropy  # store the seed to regenerate the sequence of this block
+print('trial sequence seed:', seed)
+trial_codes = oddball_sequence(n_trials=600, deviant_freq=0.2, min_standards=1, seed=seed)
+timing_log.meta['seed'] = seed
+# (stimulus, loudspeaker, trigger code): deviants 1-4 from speakers 20 / 26 / 8 / 38, standard 5 from speaker 23
+trials = trial_list(trial_codes, stimulus='noise')
+
+
+def pause():
+    print('\n Point laser at previous sound source and press button to continue. \n')
+    timing_log.flush()  # write the timing of the trials so far
+    backend.wait_for_button()
+
+
+# only speaker channel and trigger code are written per trial, while the previous trial's silence plays
+onsets = scheduler.run(trials, on_trial=lambda n, trial: print(n + 1), pause_every=40, on_pause=pause)
+timing_log.flush()
+print(timing_summary(onsets, scheduler.soa))  # stimulus onset asynchrony and jitter in ms
+# per-stage latencies and drift; align with the .vmrk markers later with trial_timing.align_with_markers
+print(timing_report(*read_timing_log(timing_log.fname), soa=scheduler.soa))
 print('Block complete :)')
 
 
@@ -0,0 +1,168 @@
+"""
+On-disk store of the preprocessed epochs of all subjects, read by condition, channel and time window:
+    store = EpochStore(eeg_DIR / 'epoch_store')
+    store.add_epochs('vanessa', epochs)  # or store.add_file(eeg_DIR / 'vanessa-epo.fif')
+    fcz_front = store.get('vanessa', 'front', picks='FCz', tmin=0., tmax=0.3)  # epochs x 1 x times
+    averages = store.averages('left', picks=['FCz', 'Cz'])  # {subject: channels x times}
+Every subject is a float32 channels x epochs x times .npy file with the epochs sorted by condition.
+"""
+import json
+import os
+import pathlib
+import mne
+import numpy as np
+from profiling import stage
+
+
+class EpochStore:
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._meta = None
+        self._data = {}  # subject: memory map
+
+    @property
+    def meta(self):
+        """ ch_names, sfreq, tmin, n_times and event_id shared by all subjects """
+        if self._meta is None and (self.path / 'store.json').exists():
+            with open(self.path / 'store.json') as f:
+                self._meta = json.load(f)
+        return self._meta
+
+    @property
+    def ch_names(self):
+        return self.meta['ch_names']
+
+    @property
+    def times(self):
+        return self.meta['tmin'] + np.arange(self.meta['n_times']) / self.meta['sfreq']
+
+    @property
+    def subjects(self):
+        return sorted(f.stem for f in self.path.glob('*.json') if f.name != 'store.json')
+
+    def info(self):
+        return mne.io.read_info(self.path / 'info.fif', verbose='error')
+
+    def subject_meta(self, subject):
+        with open(self.path / f'{subject}.json') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write(fname, write):
+        """ write(file object) or an mne Info to fname """
+        # write and rename, so readers never see half-written files
+        tmp = fname.with_name(f'tmp{os.getpid()}_' + fname.name)
+        if isinstance(write, mne.Info):
+            mne.io.write_info(tmp, write)
+        else:
+            with open(tmp, 'wb') as f:
+                write(f)
+        os.replace(tmp, fname)
+
+    def add_epochs(self, subject, epochs, overwrite=True):
+        """ store a subject's (preloaded or not) mne Epochs; ch_names / times must match the store """
+        meta = dict(ch_names=epochs.ch_names, sfreq=epochs.info['sfreq'], tmin=float(epochs.times[0]),
+                    n_times=len(epochs.times), event_id=epochs.event_id)
+        self.path.mkdir(parents=True, exist_ok=True)
+        if self.meta is None:
+            self._write(self.path / 'store.json', lambda f: f.write(json.dumps(meta, indent=2).encode()))
+            self._write(self.path / 'info.fif', epochs.info)
+            self._meta = meta
+        elif any(self.meta[key] != meta[key] for key in ('ch_names', 'n_times')) or \
+                not np.isclose(self.meta['sfreq'], meta['sfreq']) or not np.isclose(self.meta['tmin'], meta['tmin']):
+            raise ValueError(f'{subject}: channels or times differ from the epochs in {self.path}')
+        if not overwrite and (self.path / f'{subject}.json').exists():
+            raise FileExistsError(f'{subject} is already in {self.path}')
+        # sort the epochs by condition (stable, so the original order is kept within a condition)
+        order = np.argsort(epochs.events[:, 2], kind='stable')
+        codes = epochs.events[order, 2]
+        conditions = {}
+        for name, code in epochs.event_id.items():
+            start, stop = np.searchsorted(codes, code), np.searchsorted(codes, code, side='right')
+            conditions[name] = [int(start), int(stop)]
+        with stage('epoch_store') as record:
+            record.input(epochs)
+            data = np.empty((len(epochs.ch_names), len(order), len(epochs.times)), dtype=np.float32)
+            for code in np.unique(codes):
+                # one condition at a time, so non-preloaded epochs are never read at once
+                sel = np.flatnonzero(codes == code)
+                data[:, sel] = epochs[order[sel]].get_data(verbose='error').astype(np.float32).transpose(1, 0, 2)
+            self._data.pop(subject, None)
+            self._write(self.path / f'{subject}.npy', lambda f: np.save(f, record.output(data)))
+            self._write(self.path / f'{subject}_events.npy', lambda f: np.save(f, epochs.events[order]))
+            subject_meta = dict(n_epochs=len(order), conditions=conditions, selection=epochs.selection[order].tolist(),
+                                event_id=epochs.event_id)
+            self._write(self.path / f'{subject}.json', lambda f: f.write(json.dumps(subject_meta).encode()))
+
+    def add_file(self, fname, subject=None, overwrite=True):
+        """ store the epochs of an -epo.fif file (read without preloading) """
+        subject = subject or pathlib.Path(fname).name.replace('-epo.fif', '')
+        self.add_epochs(subject, mne.read_epochs(fname, preload=False, verbose='error'), overwrite)
+
+    def memmap(self, subject):
+        """ the subject's data (channels x epochs x times, sorted by condition) as read-only memory map """
+        if subject not in self._data:
+            self._data[subject] = np.load(self.path / f'{subject}.npy', mmap_mode='r')
+        return self._data[subject]
+
+    def _picks(self, picks):
+        if picks is None:
+            return slice(None)
+        if isinstance(picks, (str, int, np.integer)):
+            picks = [picks]
+        idx = [self.ch_names.index(ch) if isinstance(ch, str) else int(ch) for ch in picks]
+        if not idx:
+            raise ValueError('no channels picked')
+        # contiguous channel ranges stay a view on the file
+        return slice(idx[0], idx[-1] + 1) if np.all(np.diff(idx) == 1) else idx
+
+    def _samples(self, tmin, tmax):
+        times = self.times
+        start = 0 if tmin is None else int(np.searchsorted(times, tmin - 1e-9))
+        stop = len(times) if tmax is None else int(np.searchsorted(times, tmax + 1e-9, side='right'))
+        return slice(start, stop)
+
+    def get(self, subject, condition=None, picks=None, tmin=None, tmax=None):
+        """ epochs x channels x times of a subject's condition(s), channels and time window [tmin, tmax] """
+        data = self.memmap(subject)
+        conditions = self.subject_meta(subject)['conditions']
+        if condition is None:
+            epochs = slice(None)
+        elif isinstance(condition, str):
+            epochs = slice(*conditions[condition])
+        else:
+            epochs = np.concatenate([np.arange(*conditions[name]) for name in condition])
+        channels, samples = self._picks(picks), self._samples(tmin, tmax)
+        # slices are views of the memory map: apply them first, so the index arrays copy only the selection
+        out = data[channels if isinstance(channels, slice) else slice(None),
+                   epochs if isinstance(epochs, slice) else slice(None), samples]
+        if not isinstance(channels, slice) and not isinstance(epochs, slice):
+            out = out[np.ix_(channels, epochs)]
+        elif not isinstance(channels, slice):
+            out = out[channels]
+        elif not isinstance(epochs, slice):
+            out = out[:, epochs]
+        return np.ascontiguousarray(out.transpose(1, 0, 2))
+
+    def events(self, subject, condition=None):
+        """ events (sample, 0, code) of the stored epochs, in the same order as get() returns them """
+        events = np.load(self.path / f'{subject}_events.npy')
+        if condition is None:
+            return events
+        return events[slice(*self.subject_meta(subject)['conditions'][condition])]
+
+    def averages(self, condition, picks=None, tmin=None, tmax=None, subjects=None):
+        """ {subject: channels x times average of the condition} for all subjects that have the condition """
+        averages = {}
+        for subject in subjects or self.subjects:
+            start, stop = self.subject_meta(subject)['conditions'].get(condition, (0, 0))
+            if stop > start:
+                averages[subject] = self.get(subject, condition, picks, tmin, tmax).mean(axis=0, dtype=np.float64)
+        return averages
+
+    def to_epochs(self, subject, condition=None):
+        """ a subject's epochs (all, or one condition) as mne EpochsArray """
+        return mne.EpochsArray(self.get(subject, condition).astype(np.float64), self.info(),
+                               events=self.events(subject, condition), tmin=self.meta['tmin'],
+                               event_id=self.subject_meta(subject)['event_id'], on_missing='ignore', verbose='error')
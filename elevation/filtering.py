@@ -0,0 +1,117 @@
+"""
+Block-wise filtering of long recordings from disk (BrainVisionMemmap / np.memmap) into an output memmap.
+"""
+import mne
+import numpy as np
+from scipy.signal import fftconvolve
+
+
+def _read(source, picks, start, stop):
+    # source: BrainVisionMemmap (converted to volts) or any (channels x samples) array / memmap
+    if hasattr(source, 'get_data'):
+        return source.get_data(picks, start=start, stop=stop)
+    data = source[:, start:stop] if picks is None else source[picks, start:stop]
+    return np.asarray(data, dtype=np.float64)
+
+
+def _n_samples(source):
+    return source.n_samples if hasattr(source, 'n_samples') else source.shape[-1]
+
+
+def _read_padded(source, picks, start, stop, n_samples, edge):
+    """ samples [start, stop), padded outside the recording like mne's 'reflect_limited' """
+    left, right = max(-start, 0), max(stop - n_samples, 0)
+    parts = []
+    if left:
+        head = edge[0]
+        parts.append(2 * head[:, :1] - head[:, left:0:-1])
+    parts.append(_read(source, picks, max(start, 0), min(stop, n_samples)))
+    if right:
+        tail = edge[1]
+        parts.append(2 * tail[:, -1:] - tail[:, -2:-right - 2:-1])
+    return np.concatenate(parts, axis=-1) if len(parts) > 1 else parts[0]
+
+
+def bandpass_fir(sfreq, l_freq, h_freq, **kwargs):
+    """ the zero-phase FIR filter that raw.filter(l_freq, h_freq) uses by default """
+    kwargs = dict(dict(method='fir', phase='zero', fir_window='hamming', fir_design='firwin'), **kwargs)
+    return mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose='error', **kwargs)
+
+
+def stream_filter(source, sfreq, l_freq, h_freq, out=None, picks=None, block_size=2 ** 16, dtype=np.float64,
+                  h=None, decim=1):
+    """
+    raw.filter(l_freq, h_freq) of (channels x samples) data in blocks of block_size samples (overlap-save).
+    out: .npy path to create as memmap, a preallocated array or None; decim: keep every decim-th sample.
+    """
+    if h is None:
+        h = bandpass_fir(sfreq, l_freq, h_freq)
+    n_samples = _n_samples(source)
+    n_channels = len(np.atleast_1d(picks)) if picks is not None else \
+        (source.n_channels if hasattr(source, 'n_channels') else source.shape[0])
+    half = (len(h) - 1) // 2  # zero-phase: the odd-length filter is centered on each output sample
+    if n_samples <= len(h):
+        raise ValueError(f'recording ({n_samples} samples) is shorter than the filter ({len(h)} samples)')
+    n_out = -(-n_samples // decim)
+    block_size = max(block_size // decim, 1) * decim  # blocks start on a kept sample
+    if out is None or isinstance(out, (str, bytes)) or hasattr(out, '__fspath__'):
+        out = np.empty((n_channels, n_out), dtype=dtype) if out is None else \
+            np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(n_channels, n_out))
+    edge = (_read(source, picks, 0, half + 1), _read(source, picks, n_samples - half - 1, n_samples))
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        segment = _read_padded(source, picks, start - half, stop + half, n_samples, edge)
+        filtered = fftconvolve(segment, h[None], mode='valid', axes=-1)
+        out[:, start // decim:-(-stop // decim)] = filtered[:, ::decim]
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def decimation_factor(sfreq, sfreq_new, h_freq, h_trans_bandwidth='auto'):
+    """ integer factor from sfreq to sfreq_new; ValueError if the low-pass doesn't end below the new Nyquist """
+    decim = int(round(sfreq / sfreq_new))
+    if decim < 1 or abs(sfreq / decim - sfreq_new) > 1e-6:
+        raise ValueError(f'sfreq_new ({sfreq_new} Hz) must be an integer fraction of the sampling rate ({sfreq} Hz)')
+    if h_freq is None:
+        raise ValueError(f'decimating to {sfreq_new} Hz needs a low-pass (h_freq) as anti-alias filter')
+    if h_trans_bandwidth == 'auto':  # same rule as mne's default for the low-pass edge
+        h_trans_bandwidth = min(max(h_freq * 0.25, 2.), sfreq / 2. - h_freq)
+    if h_freq + h_trans_bandwidth > sfreq_new / 2.:
+        raise ValueError(f'low-pass at {h_freq} Hz (+{h_trans_bandwidth} Hz transition) would alias '
+                         f'at {sfreq_new} Hz; lower h_freq or keep a higher sampling rate')
+    return decim
+
+
+def filter_decimate(source, sfreq, l_freq, h_freq, sfreq_new, out=None, picks=None, block_size=2 ** 16,
+                    dtype=np.float64):
+    """ band-pass and keep every decim-th sample in one pass (the low-pass is the anti-alias filter) """
+    decim = decimation_factor(sfreq, sfreq_new, h_freq)
+    return stream_filter(source, sfreq, l_freq, h_freq, out, picks, block_size, dtype, decim=decim)
+
+
+def decimate_events(events, decim, n_times=None):
+    """
+    map event samples (mne events array, n x 3) to the nearest decimated sample (halves round up); n_times: samples
+    after decimation, events in the last decim // 2 samples that would round past the end are clipped to the last one
+    """
+    events = np.array(events, copy=True)
+    events[:, 0] = (events[:, 0] + decim // 2) // decim
+    if n_times is not None:
+        events[:, 0] = np.minimum(events[:, 0], n_times - 1)
+    return events
+
+
+def filter_decimate_raw(raw, l_freq, h_freq, sfreq_new, block_size=2 ** 16):
+    """ filtered and decimated copy of a preloaded Raw (remap its events with decimate_events) """
+    decim = decimation_factor(raw.info['sfreq'], sfreq_new, h_freq)
+    data = stream_filter(raw._data, raw.info['sfreq'], l_freq, h_freq, block_size=block_size, decim=decim)
+    info = raw.info.copy()
+    with info._unlock():
+        info['sfreq'] = raw.info['sfreq'] / decim
+        info['lowpass'] = h_freq
+        if l_freq is not None:
+            info['highpass'] = l_freq
+    raw_new = mne.io.RawArray(data, info, first_samp=raw.first_samp // decim, verbose='error')
+    raw_new.set_annotations(raw.annotations)
+    return raw_new
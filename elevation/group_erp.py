@@ -0,0 +1,137 @@
+"""
+Group-level ERPs from running per-condition means and variances, added one subject at a time.
+"""
+import pathlib
+import mne
+import numpy as np
+from pipeline_cache import event_id
+
+
+class _Welford:
+    """ running mean and sum of squared deviations (M2) of arrays, updated with whole batches """
+
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add_batch(self, n, mean, m2):
+        # Chan et al. combination of two sets of observations
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    def add(self, x):
+        self.add_batch(1, x, 0.)
+
+    @property
+    def sum(self):
+        return self.mean * self.n
+
+    def variance(self, ddof=1):
+        return self.m2 / (self.n - ddof) if self.n > ddof else np.full_like(self.m2, np.nan)
+
+    def sem(self):
+        return np.sqrt(self.variance() / self.n)
+
+
+class ERPAccumulator:
+    """
+    trial- and subject-level running statistics per condition, e.g.:
+        acc = ERPAccumulator()
+        for fname in eeg_DIR.glob('*-epo.fif'):
+            acc.add_file(fname)
+        diff = acc.difference_wave('left')  # deviant minus 'front' standard, averaged over subjects
+    """
+
+    def __init__(self, event_id=event_id, picks=None, standard='front'):
+        self.event_id = event_id
+        self.picks = picks
+        self.standard = standard
+        self.info = None
+        self.times = None
+        self.trials = {}  # condition: _Welford over trials
+        self.subjects = {}  # condition: _Welford over subject averages
+        self.differences = {}  # deviant condition: _Welford over subject difference waves
+        self.subject_averages = {}  # subject: {condition: (n trials, channels x times average)}
+
+    @property
+    def ch_names(self):
+        return self.info['ch_names']
+
+    def add_epochs(self, subject, epochs):
+        """ add one subject's epochs (mne Epochs, data is read per condition) """
+        self._set_channels(subject, epochs.info, epochs.times)
+        self._add(subject, lambda condition: epochs[condition].get_data(picks=self.ch_names)
+                  if condition in epochs.event_id and len(epochs[condition]) else None)
+
+    def add_store(self, store, subjects=None):
+        """ add subjects (default all) of an epoch_store.EpochStore """
+        for subject in subjects or store.subjects:
+            self._set_channels(subject, store.info(), store.times)
+            conditions = store.subject_meta(subject)['conditions']
+            self._add(subject, lambda condition: store.get(subject, condition, picks=self.ch_names)
+                      .astype(np.float64) if np.diff(conditions.get(condition, (0, 0)))[0] > 0 else None)
+
+    def _set_channels(self, subject, info, times):
+        if self.info is None:
+            sel = mne.pick_types(info, meg=True, eeg=True, exclude=[]) if self.picks is None else \
+                mne.pick_channels(info.ch_names, self.picks, ordered=True)
+            self.info = mne.pick_info(info, sel)
+            self.times = np.array(times)
+        elif not np.allclose(times, self.times):
+            raise ValueError(f'{subject}: epoch times differ from the first subject')
+
+    def _add(self, subject, get_data):
+        # get_data(condition): epochs x channels x times of the condition, None if the subject has none
+        averages = {}
+        for condition in self.event_id:
+            data = get_data(condition)
+            if data is None:
+                continue
+            n, mean = len(data), data.mean(axis=0)
+            m2 = ((data - mean) ** 2).sum(axis=0)
+            self.trials.setdefault(condition, _Welford(mean.shape)).add_batch(n, mean, m2)
+            self.subjects.setdefault(condition, _Welford(mean.shape)).add(mean)
+            averages[condition] = (n, mean)
+        if self.standard in averages:
+            for condition, (n, mean) in averages.items():
+                if condition != self.standard:
+                    self.differences.setdefault(condition, _Welford(mean.shape)).add(
+                        mean - averages[self.standard][1])
+        self.subject_averages[subject] = averages
+
+    def add_file(self, fname, subject=None):
+        """ add the subject stored in an -epo.fif file without preloading it """
+        subject = subject or pathlib.Path(fname).name.replace('-epo.fif', '')
+        self.add_epochs(subject, mne.read_epochs(fname, preload=False, verbose='error'))
+
+    def _evoked(self, data, nave, comment):
+        return mne.EvokedArray(data, self.info, tmin=self.times[0], nave=max(int(nave), 1), comment=comment,
+                               verbose='error')
+
+    def grand_average(self, condition, weighting='trials'):
+        """ grand average as mne Evoked, over all trials (weighting='trials') or the subject averages """
+        stats = self.trials[condition] if weighting == 'trials' else self.subjects[condition]
+        return self._evoked(stats.mean, self.trials[condition].n, condition)
+
+    def standard_error(self, condition, level='subjects'):
+        """ standard error (channels x times) across subject averages or across all trials """
+        return (self.subjects[condition] if level == 'subjects' else self.trials[condition]).sem()
+
+    def subject_evoked(self, subject, condition):
+        n, mean = self.subject_averages[subject][condition]
+        return self._evoked(mean, n, f'{subject} {condition}')
+
+    def difference_wave(self, deviant):
+        """ deviant minus standard, averaged over subjects, as mne Evoked """
+        return self._evoked(self.differences[deviant].mean, self.differences[deviant].n,
+                            f'{deviant} - {self.standard}')
+
+    def difference_sem(self, deviant):
+        """ standard error of the difference wave across subjects (channels x times) """
+        return self.differences[deviant].sem()
@@ -0,0 +1,82 @@
+"""
+ICA for the elevation pipeline: cached fits, automatic blink components and cleaning with one matrix.
+"""
+import pathlib
+import mne
+import numpy as np
+from pipeline_cache import data_key
+from profiling import profiled
+
+frontal_channels = ('Fp1', 'Fp2', 'AF7', 'AF8')
+
+
+@profiled('ica_fit')
+def fit_ica(epochs, n_components=0.99, method='fastica', decim=2, l_freq=1., random_state=42,
+            cache_dir=None, name='ica'):
+    """
+    fit ICA on a copy of the epochs high-passed at l_freq (IIR, the epochs are too short for a FIR) and
+    decimated by decim; with cache_dir the fit is stored per data and parameters and reloaded.
+    The high-pass also removes the offsets of a baseline correction, so the copy is not marked as baseline-corrected
+    """
+    params = dict(n_components=n_components, method=method, decim=decim, l_freq=l_freq, random_state=random_state)
+    fname = None
+    if cache_dir is not None:
+        key = data_key(params, epochs.get_data(copy=False), epochs.ch_names)
+        fname = pathlib.Path(cache_dir) / f'{name}_{key}-ica.fif'
+        if fname.exists():
+            return mne.preprocessing.read_ica(fname, verbose='error')
+    fit_epochs = epochs
+    if l_freq is not None:
+        filtered = epochs.copy().filter(l_freq=l_freq, h_freq=None, method='iir', verbose='error')
+        fit_epochs = mne.EpochsArray(filtered.get_data(copy=False), filtered.info, filtered.events, filtered.tmin,
+                                     filtered.event_id, baseline=None, verbose='error')
+    ica = mne.preprocessing.ICA(n_components=n_components, method=method, random_state=random_state)
+    ica.fit(fit_epochs, decim=decim)
+    if fname is not None:
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        ica.save(fname, overwrite=True, verbose='error')
+    return ica
+
+
+def blink_scores(ica, epochs, channels=frontal_channels):
+    """ absolute correlation of every ICA source with every frontal channel (components x channels) """
+    channels = [ch for ch in channels if ch in epochs.ch_names]
+    if not channels:
+        raise ValueError(f'none of the frontal channels {frontal_channels} are in the data')
+    sources = ica.get_sources(epochs).get_data(copy=False)  # epochs x components x times
+    sources = sources.transpose(1, 0, 2).reshape(sources.shape[1], -1)
+    frontal = epochs.get_data(picks=channels)
+    frontal = frontal.transpose(1, 0, 2).reshape(len(channels), -1)
+    sources = (sources - sources.mean(1, keepdims=True)) / sources.std(1, keepdims=True)
+    frontal = (frontal - frontal.mean(1, keepdims=True)) / frontal.std(1, keepdims=True)
+    return np.abs(sources @ frontal.T) / sources.shape[1]
+
+
+def find_blink_components(ica, epochs, channels=frontal_channels, threshold=0.6, max_components=2):
+    """ components correlating with a frontal channel by at least threshold, strongest first """
+    scores = blink_scores(ica, epochs, channels).max(axis=1)
+    order = np.argsort(scores)[::-1]
+    return [int(comp) for comp in order[:max_components] if scores[comp] >= threshold]
+
+
+def cleaning_matrix(ica, info, exclude=None):
+    """
+    (picks, matrix, offset) with ica.apply(data, exclude) == matrix @ data + offset on the picked channels,
+    measured by applying the ICA once to unit impulses
+    """
+    exclude = ica.exclude if exclude is None else exclude
+    picks = np.array([info['ch_names'].index(ch) for ch in ica.ch_names])
+    probe = np.zeros((len(info['ch_names']), len(picks) + 1))
+    probe[picks, np.arange(1, len(picks) + 1)] = 1.
+    probe = mne.EvokedArray(probe, info, verbose='error')
+    cleaned = ica.apply(probe, exclude=exclude, verbose='error').data[picks]
+    offset = cleaned[:, 0]
+    return picks, cleaned[:, 1:] - offset[:, None], offset
+
+
+@profiled('ica_apply')
+def apply_ica(epochs, ica, exclude=None):
+    """ remove the excluded components (default ica.exclude) from the epochs in place with one matrix product """
+    picks, matrix, offset = cleaning_matrix(ica, epochs.info, exclude)
+    epochs._data[:, picks] = matrix @ epochs._data[:, picks] + offset[:, None]
+    return epochs
@@ -3,6 +3,8 @@
 import mne
 import pathlib
 import pickle
+import matplotlib.pyplot as plt
+from montage_registry import interpolate_bads
 # define paths to current folders
 DIR = pathlib.Path.cwd()
 eeg_DIR = DIR / 'elevation' / "data"
@@ -66,7 +68,9 @@ epochs.average().plot()
 epochs.info['bads'] += ['FC2']
 # A possibility to "repair" a bad channel is to interpolate its signal based on the information
 # from the other channels. This can be done with this command:
-epochs.interpolate_bads()
+# epochs.interpolate_bads()
+# the same with a spline matrix that is computed once per set of bad channels and reused afterwards:
+interpolate_bads(epochs)
 
 # On the other hand, there might be specific epochs that we should exclude (for example, due to
 # extensive movement artifacts). This we can do manually when inspecting the data:
@@ -97,13 +101,22 @@ epochs_auto.plot_drop_log()  # summary of rejected epochs per channel
 # interpolated (repaired). Setting the random_state makes the process
 # deterministic so everyone gets the same result.
 
-from autoreject import AutoReject # import the module
-ar=AutoReject(n_interpolate=[3,6,12], random_state=42)
-epochs_ar, reject_log = ar.fit_transform(epochs, return_log=True)
+# from autoreject import AutoReject # import the module
+# ar=AutoReject(n_interpolate=[3,6,12], random_state=42)
+# epochs_ar, reject_log = ar.fit_transform(epochs, return_log=True)
+
+# the same with autoreject_tools.py: thresholds are cached, reruns only apply them
+# (n_jobs > 1 needs an `if __name__ == '__main__':` guard around the script on Windows)
+from autoreject_tools import fit_autoreject, apply_autoreject
+ar_fit = fit_autoreject(epochs, n_interpolate=[3, 6, 12], random_state=42, n_jobs=1,
+                        cache_dir=eeg_DIR / 'cache', name='vanessa')
+epochs_ar, bad_matrix = apply_autoreject(epochs.copy(), ar_fit)
 
 
 # Lets have a look at what AutoReject did to the data:
-reject_log.plot_epochs(epochs)  # one should carefully check that not too much of the data was removed...
+epochs_ar.plot_drop_log()  # one should carefully check that not too much of the data was removed...
+# bad_matrix shows which channel exceeded its threshold in which epoch:
+plt.imshow(bad_matrix.T, aspect='auto', interpolation='none')
 
 
 # However for now, let´s continue working with the not-fully automatized rejection approach
@@ -0,0 +1,205 @@
+"""
+Parsed montages, channel mapping and cached spherical spline matrices of the elevation scripts:
+    registry = MontageRegistry(cache_dir=eeg_DIR / 'cache')
+    raw.rename_channels(registry.mapping())
+    raw.set_montage(registry.montage(DIR / 'AS-96_REF_c.bvef').to_mne())
+    interpolate_bads(epochs, registry=registry)  # instead of epochs.interpolate_bads()
+    grid = registry.topomap_grid(evoked.info)  # the same scalp interpolation for every topomap frame
+"""
+import hashlib
+import pathlib
+import pickle
+from collections import OrderedDict
+import mne
+import numpy as np
+from array_cache import cached_array
+from profiling import profiled
+
+try:
+    from mne.channels.interpolation import _make_interpolation_matrix
+except ImportError as err:  # private mne function, its location is not stable across mne versions
+    raise ImportError(f'mne {mne.__version__} has no mne.channels.interpolation._make_interpolation_matrix, '
+                      'which montage_registry needs for the spline matrices (tested with mne 1.13)') from err
+
+DIR = pathlib.Path(__file__).resolve().parent.parent
+_fiducials = ('nasion', 'lpa', 'rpa')
+
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class Montage:
+    """ electrode names, positions (metres), fiducials and adjacency of a montage file """
+
+    def __init__(self, names, pos, fiducials, coord_frame, adjacency):
+        self.names, self.pos, self.fiducials, self.coord_frame, self.adjacency = \
+            list(names), pos, fiducials, coord_frame, adjacency
+
+    @classmethod
+    def from_file(cls, path):
+        montage = mne.channels.read_custom_montage(fname=path)
+        positions = montage.get_positions()
+        names = list(positions['ch_pos'])
+        pos = np.array([positions['ch_pos'][ch] for ch in names])
+        fiducials = np.array([positions[fid] if positions[fid] is not None else np.full(3, np.nan)
+                              for fid in _fiducials])
+        info = mne.create_info(names, 1000., 'eeg')
+        info.set_montage(montage, verbose='error')
+        with mne.utils.use_log_level('error'):
+            adjacency, _ = mne.channels.find_ch_adjacency(info, 'eeg')
+        return cls(names, pos, fiducials, positions['coord_frame'], adjacency.toarray().astype(bool))
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as store:
+            return cls(store['names'].tolist(), store['pos'], store['fiducials'], str(store['coord_frame']),
+                       store['adjacency'])
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            np.savez(f, names=np.array(self.names), pos=self.pos, fiducials=self.fiducials,
+                     coord_frame=np.array(self.coord_frame), adjacency=self.adjacency)
+
+    def neighbours(self, ch):
+        """ names of the electrodes adjacent to ch """
+        idx = self.names.index(ch)
+        return [name for i, name in enumerate(self.names) if self.adjacency[idx, i] and i != idx]
+
+    def to_mne(self):
+        """ the montage as mne DigMontage, e.g. for raw.set_montage """
+        fiducials = {fid: None if np.isnan(pos).any() else pos for fid, pos in zip(_fiducials, self.fiducials)}
+        return mne.channels.make_dig_montage(ch_pos=dict(zip(self.names, self.pos)), coord_frame=self.coord_frame,
+                                             **fiducials)
+
+
+class TopomapGrid:
+    """ spherical spline matrix from the channels to the pixels of a res x res topomap grid """
+
+    def __init__(self, ch_names, coords, radius, res, inside, matrix):
+        self.ch_names, self.coords, self.radius, self.res = list(ch_names), coords, radius, res
+        self.inside = inside  # res x res mask of the pixels within radius
+        self.matrix = matrix  # (pixels inside x channels)
+
+    @staticmethod
+    def project(pos):
+        """ 2D topomap coordinates of positions relative to the sphere origin """
+        theta = np.arccos(np.clip(pos[:, 2] / np.linalg.norm(pos, axis=1), -1, 1))
+        phi = np.arctan2(pos[:, 1], pos[:, 0])
+        return np.column_stack([np.cos(phi), np.sin(phi)]) * (theta / (np.pi / 2))[:, None]
+
+    @staticmethod
+    def pixels(radius, res):
+        """ (res x res mask of the pixels within radius, 2D coordinates of those pixels) """
+        x = np.linspace(-radius, radius, res)
+        xx, yy = np.meshgrid(x, x)
+        inside = np.hypot(xx, yy) <= radius
+        return inside, np.column_stack([xx[inside], yy[inside]])
+
+    @property
+    def extent(self):
+        return -self.radius, self.radius, -self.radius, self.radius
+
+    def images(self, data):
+        """ (channels,) or (channels x maps) values -> res x res (x maps) images, NaN outside the head """
+        data = np.asarray(data)
+        out = np.full((self.res, self.res) + data.shape[1:], np.nan)
+        out[self.inside] = self.matrix @ data
+        return out
+
+
+class MontageRegistry:
+    """ montages and mappings by file content, LRU cache of matrices (also saved in cache_dir if given) """
+
+    def __init__(self, max_size=64, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else None
+        self._montages = {}
+        self._mappings = {}
+        self._matrices = OrderedDict()
+
+    def montage(self, path=DIR / 'AS-96_REF_c.bvef'):
+        key = _file_hash(path)
+        if key not in self._montages:
+            fname = self.cache_dir / f'montage_{key}.npz' if self.cache_dir is not None else None
+            if fname is not None and fname.exists():
+                self._montages[key] = Montage.load(fname)
+            else:
+                self._montages[key] = Montage.from_file(path)
+                if fname is not None:
+                    self.cache_dir.mkdir(parents=True, exist_ok=True)
+                    self._montages[key].save(fname)
+        return self._montages[key]
+
+    def mapping(self, path=DIR / 'channel_mapping.pkl'):
+        """ the channel name mapping ({'1': 'Fp1', ...}) stored in path """
+        key = _file_hash(path)
+        if key not in self._mappings:
+            with open(path, 'rb') as f:
+                self._mappings[key] = pickle.load(f)
+        return dict(self._mappings[key])
+
+    @staticmethod
+    def key(pos, good, bad):
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(pos, dtype=float).tobytes())
+        h.update(repr((list(good), list(bad))).encode())
+        return h.hexdigest()
+
+    def interpolation_matrix(self, info, bads, picks=None):
+        """ (bad x good channels of picks) spherical spline matrix, as inst.interpolate_bads() """
+        picks = mne.pick_types(info, eeg=True, exclude=[]) if picks is None else np.asarray(picks)
+        names = [info['ch_names'][i] for i in picks]
+        pos = np.array([info['chs'][i]['loc'][:3] for i in picks])
+        is_bad = np.isin(names, list(bads))
+        good, bad = [n for n, b in zip(names, is_bad) if not b], [n for n, b in zip(names, is_bad) if b]
+
+        def compute():
+            _, origin, _ = mne.bem.fit_sphere_to_headshape(info, units='m', verbose='error')
+            return _make_interpolation_matrix(pos[~is_bad] - origin, pos[is_bad] - origin)
+
+        return cached_array(self._matrices, f'interpolation_{self.key(pos, good, bad)}', compute, self.max_size,
+                            self.cache_dir)
+
+    def topomap_grid(self, info, picks=None, res=64):
+        """ cached TopomapGrid of the channels in picks (default all EEG channels) """
+        picks = mne.pick_types(info, eeg=True, exclude=[]) if picks is None else np.asarray(picks)
+        names = [info['ch_names'][i] for i in picks]
+        _, origin, _ = mne.bem.fit_sphere_to_headshape(info, units='m', verbose='error')
+        pos = np.array([info['chs'][i]['loc'][:3] for i in picks]) - origin
+        coords = TopomapGrid.project(pos)
+        radius = max(1., np.linalg.norm(coords, axis=1).max() * 1.05)  # lower channels lie outside the circle
+        inside, pixels = TopomapGrid.pixels(radius, res)
+
+        def compute():
+            # pixels back onto the unit sphere
+            theta, phi = np.hypot(*pixels.T) * np.pi / 2, np.arctan2(pixels[:, 1], pixels[:, 0])
+            pixel_pos = np.column_stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)])
+            return _make_interpolation_matrix(pos, pixel_pos)
+
+        matrix = cached_array(self._matrices, f'topomap_{self.key(pos, names, ["topomap", res])}', compute,
+                              self.max_size, self.cache_dir)
+        return TopomapGrid(names, coords, radius, res, inside, matrix)
+
+    def clear(self):
+        self._montages.clear()
+        self._mappings.clear()
+        self._matrices.clear()
+
+
+# shared by all calls that don't pass their own registry
+default_registry = MontageRegistry()
+
+
+@profiled('interpolate_bads')
+def interpolate_bads(inst, reset_bads=True, registry=None):
+    """ inst.interpolate_bads() in place with a cached matrix of registry (default_registry if None) """
+    picks = mne.pick_types(inst.info, eeg=True, exclude=[])
+    is_bad = np.isin([inst.ch_names[i] for i in picks], inst.info['bads'])
+    if is_bad.any():
+        matrix = (registry or default_registry).interpolation_matrix(inst.info, inst.info['bads'], picks)
+        inst._data[..., picks[is_bad], :] = np.matmul(matrix, inst._data[..., picks[~is_bad], :])
+    if reset_bads:
+        inst.info['bads'] = [ch for ch in inst.info['bads'] if ch not in [inst.ch_names[i] for i in picks]]
+    return inst
@@ -0,0 +1,44 @@
+"""
+Constrained oddball trial sequences for the elevation experiment, generated in linear time:
+    codes = oddball_sequence(600, deviant_freq=0.2, min_standards=1, seed=1)
+    trials = trial_list(codes)  # (stimulus, speaker, trigger code) for stimulus_scheduler.TrialScheduler
+"""
+import numpy as np
+
+standard = 5  # trigger code of the standard, played from the central speaker
+speakers = {1: 20,  # az: 0, ele: 37.5
+            2: 26,  # az: 0, ele: -37.5
+            3: 8,  # az: -35, ele: 0
+            4: 38,  # az: 35, ele: 0
+            5: 23}  # az: 0, ele: 0 (standard)
+
+
+def oddball_sequence(n_trials=600, deviant_freq=0.2, min_standards=1, deviants=(1, 2, 3, 4), standard=standard,
+                     leading_standards=0, seed=None):
+    """
+    trigger codes of n_trials trials with round(n_trials * deviant_freq) balanced deviants, at least min_standards
+    standards between two deviants; every sequence meeting the constraints is equally likely
+    """
+    rng = np.random.default_rng(seed)
+    n_deviants = int(round(n_trials * deviant_freq))
+    # standards that can be placed freely once the required ones are set aside
+    n_free = n_trials - n_deviants - max(n_deviants - 1, 0) * min_standards - (leading_standards if n_deviants else 0)
+    if n_free < 0:
+        raise ValueError(f'{n_deviants} deviants with {min_standards} standards in between '
+                         f'don\'t fit into {n_trials} trials')
+    # deviant positions in the sequence without the required standards: n_deviants of n_free + n_deviants slots
+    is_deviant = np.zeros(n_free + n_deviants, dtype=bool)
+    is_deviant[rng.choice(n_free + n_deviants, n_deviants, replace=False)] = True
+    positions = np.flatnonzero(is_deviant)
+    # put the required standards back in front of every deviant but the first
+    positions += np.arange(n_deviants) * min_standards + (leading_standards if n_deviants else 0)
+    counts = np.full(len(deviants), n_deviants // len(deviants))
+    counts[rng.choice(len(deviants), n_deviants % len(deviants), replace=False)] += 1
+    codes = np.full(n_trials, standard)
+    codes[positions] = rng.permutation(np.repeat(deviants, counts))
+    return codes
+
+
+def trial_list(codes, stimulus='noise', speakers=speakers):
+    """ (stimulus name, speaker index, trigger code) for every trial, e.g. for TrialScheduler.run """
+    return [(stimulus, speakers[code], int(code)) for code in codes]
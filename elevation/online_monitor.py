@@ -0,0 +1,225 @@
+"""
+Online ERP monitor: running averages per condition and per-channel noise levels during the recording, e.g.:
+    python elevation/online_monitor.py --port 5555 --header data/vanessa_1.vhdr  # blocks sent with send_block
+    python elevation/online_monitor.py --replay data/vanessa_1.vhdr --realtime   # test with a recording
+There is no BrainVision Recorder (RDA) source: the live data has to come from a process calling send_block.
+"""
+import argparse
+import pathlib
+import socket
+import struct
+import time
+import numpy as np
+from brainvision_io import BrainVisionMemmap, read_events, read_vhdr
+from montage_registry import default_registry
+from pipeline_cache import event_id
+
+_block_header = struct.Struct('<iii')  # channels, samples, triggers
+
+
+class FileReplaySource:
+    """ stand-in for the amplifier: replays a BrainVision recording in blocks (at its own pace with realtime) """
+
+    def __init__(self, vhdr_path, block_size=50, mapping=None, realtime=False):
+        self.recording = BrainVisionMemmap(vhdr_path, mapping=mapping)
+        self.ch_names, self.sfreq = self.recording.ch_names, self.recording.sfreq
+        self.markers = read_events(vhdr_path)[:, [0, 2]]  # (sample, code) of all stimulus markers
+        self.block_size, self.realtime = block_size, realtime
+        self._pos = 0
+        self._start = None
+
+    def read_block(self):
+        """ (channels x samples float32 data in volts, (n x 2) array of (sample, code)) or None at the end """
+        if self._pos >= self.recording.n_samples:
+            return None
+        stop = min(self._pos + self.block_size, self.recording.n_samples)
+        if self.realtime:
+            self._start = self._start or time.perf_counter()
+            time.sleep(max(0., stop / self.sfreq - (time.perf_counter() - self._start)))
+        data = self.recording.get_data(start=self._pos, stop=stop, dtype=np.float32)
+        triggers = self.markers[(self.markers[:, 0] >= self._pos) & (self.markers[:, 0] < stop)]
+        self._pos = stop
+        return data, triggers
+
+
+def stream_setup(vhdr_path, mapping=None):
+    """ channel names and sampling rate from a BrainVision header (no data file needed) """
+    header = read_vhdr(vhdr_path)
+    names = [header['Channel Infos'][f'Ch{ch}'].split(',')[0].replace('\\1', ',')
+             for ch in range(1, int(header['Common Infos']['NumberOfChannels']) + 1)]
+    return [mapping.get(name, name) if mapping else name for name in names], \
+        1e6 / float(header['Common Infos']['SamplingInterval'])
+
+
+def _recv_exactly(conn, n_bytes):
+    buffer = bytearray(n_bytes)
+    view, received = memoryview(buffer), 0
+    while received < n_bytes:
+        n = conn.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('stream closed')
+        received += n
+    return buffer
+
+
+def send_block(conn, data, triggers=()):
+    """ send one block: header, float32 data (samples x channels), int32 (absolute sample, code) pairs """
+    data = np.ascontiguousarray(np.asarray(data, dtype='<f4').T)
+    triggers = np.asarray(triggers, dtype='<i4').reshape(-1, 2)
+    conn.sendall(_block_header.pack(data.shape[1], data.shape[0], len(triggers)) + data.tobytes()
+                 + triggers.tobytes())
+
+
+class SocketSource:
+    """ blocks sent with send_block to a local TCP port, accepted on the first read_block """
+
+    def __init__(self, ch_names, sfreq, port=5555, host='127.0.0.1'):
+        self.ch_names, self.sfreq = list(ch_names), sfreq
+        self._server = socket.create_server((host, port))
+        self._conn = None
+
+    def read_block(self):
+        if self._conn is None:
+            self._conn, _ = self._server.accept()
+        try:
+            n_channels, n_samples, n_triggers = _block_header.unpack(_recv_exactly(self._conn, _block_header.size))
+            data = np.frombuffer(_recv_exactly(self._conn, 4 * n_channels * n_samples), dtype='<f4')
+            triggers = np.frombuffer(_recv_exactly(self._conn, 8 * n_triggers), dtype='<i4')
+        except ConnectionError:
+            self.close()
+            return None
+        return data.reshape(n_samples, n_channels).T, triggers.reshape(-1, 2).astype(np.int64)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._server.close()
+
+
+def serve_replay(source, port=5555, host='127.0.0.1'):
+    """ send all blocks of a source (e.g. FileReplaySource) to a SocketSource listening on port """
+    with socket.create_connection((host, port)) as conn:
+        for block in iter(source.read_block, None):
+            send_block(conn, *block)
+
+
+class OnlineERPMonitor:
+    """
+    running ERP averages of a stream of blocks (an epoch is added once its last sample arrived) and
+    per-channel noise levels (exponentially weighted with time constant noise_tau seconds)
+    """
+
+    def __init__(self, ch_names, sfreq, event_id=event_id, standard='front', tmin=-0.2, tmax=0.4,
+                 baseline=(None, 0), noise_tau=10., max_block=None):
+        self.ch_names, self.sfreq, self.event_id, self.standard = list(ch_names), sfreq, event_id, standard
+        self.conditions = {code: name for name, code in event_id.items()}
+        self.start, self.stop = int(sfreq * tmin), int(sfreq * tmax)
+        self.times = np.arange(self.start, self.stop) / sfreq
+        b0 = 0 if baseline[0] is None else np.searchsorted(self.times, baseline[0])
+        b1 = len(self.times) if baseline[1] is None else np.searchsorted(self.times, baseline[1], side='right')
+        self._baseline = slice(b0, b1)
+        n_channels = len(self.ch_names)
+        # the ring holds the longest epoch plus one block of samples
+        max_block = max_block or int(sfreq)
+        self._ring = np.zeros((n_channels, self.stop - min(self.start, 0) + max_block), dtype=np.float32)
+        self.n_received = 0  # samples received so far
+        self._pending = []  # (sample, code) of triggers whose epoch isn't complete yet
+        self.averages = {name: np.zeros((n_channels, len(self.times))) for name in event_id}
+        self.counts = dict.fromkeys(event_id, 0)
+        self.noise = None
+        self._noise_tau = noise_tau
+        self.latency = dict(last=0., max=0., total=0., blocks=0)  # block processing times in seconds
+
+    def process_block(self, data, triggers=()):
+        """ add a (channels x samples) block and the (sample, code) triggers that fall into it """
+        t0 = time.perf_counter()
+        data = np.asarray(data, dtype=np.float32)
+        n = data.shape[1]
+        if n > self._ring.shape[1] - (self.stop - min(self.start, 0)):
+            raise ValueError(f'block of {n} samples is longer than max_block')
+        idx = (self.n_received + np.arange(n)) % self._ring.shape[1]
+        self._ring[:, idx] = data
+        self.n_received += n
+        self._pending += [(int(s), int(c)) for s, c in np.asarray(triggers).reshape(-1, 2) if c in self.conditions]
+        # complete epochs
+        waiting = []
+        for sample, code in self._pending:
+            if sample + self.stop > self.n_received:
+                waiting.append((sample, code))
+            elif sample + self.start >= max(self.n_received - self._ring.shape[1], 0):
+                self._add_epoch(sample, code)
+        self._pending = waiting
+        # noise level per channel
+        if n > 1:
+            alpha = 1 - np.exp(-n / (self.sfreq * self._noise_tau))
+            block_noise = data.std(axis=1)
+            self.noise = block_noise if self.noise is None else self.noise + alpha * (block_noise - self.noise)
+        elapsed = time.perf_counter() - t0
+        self.latency.update(last=elapsed, max=max(self.latency['max'], elapsed), total=self.latency['total'] + elapsed,
+                            blocks=self.latency['blocks'] + 1)
+
+    def _add_epoch(self, sample, code):
+        idx = (sample + np.arange(self.start, self.stop)) % self._ring.shape[1]
+        epoch = self._ring[:, idx].astype(np.float64)
+        epoch -= epoch[:, self._baseline].mean(axis=1, keepdims=True)
+        name = self.conditions[code]
+        self.counts[name] += 1
+        self.averages[name] += (epoch - self.averages[name]) / self.counts[name]
+
+    def difference(self, deviant):
+        """ running average of deviant minus standard (channels x times) """
+        return self.averages[deviant] - self.averages[self.standard]
+
+    def suspicious_channels(self, noisy=5., flat=0.1):
+        """ channels whose noise level is above noisy x or below flat x the median over channels """
+        if self.noise is None:
+            return [], []
+        median = np.median(self.noise)
+        return ([ch for ch, level in zip(self.ch_names, self.noise) if level > noisy * median],
+                [ch for ch, level in zip(self.ch_names, self.noise) if level < flat * median])
+
+    def status(self, channel='Cz', window=(0.1, 0.25)):
+        """ one line: trial counts, mean deviant - standard amplitude of channel in window, suspicious channels """
+        ch = self.ch_names.index(channel)
+        sel = (self.times >= window[0]) & (self.times <= window[1])
+        mmn = ' '.join(f'{name}={self.difference(name)[ch, sel].mean() * 1e6:+.2f}'
+                       for name in self.event_id if name != self.standard and self.counts[name])
+        noisy, flat = self.suspicious_channels()
+        return (f'{self.n_received / self.sfreq:6.0f} s | n={sum(self.counts.values())} | {channel} MMN µV {mmn} | '
+                f'noisy {noisy} flat {flat} | block {self.latency["last"] * 1e3:.1f} ms '
+                f'(max {self.latency["max"] * 1e3:.1f} ms)')
+
+
+def run_monitor(source, monitor=None, report_every=10., channel='Cz', **kwargs):
+    """ feed all blocks of source into a monitor (created from kwargs if not given), print its status regularly """
+    monitor = monitor or OnlineERPMonitor(source.ch_names, source.sfreq, **kwargs)
+    if channel not in monitor.ch_names:  # e.g. FCz, the online reference, isn't recorded
+        raise ValueError(f'channel {channel} is not in the stream')
+    next_report = report_every
+    for block in iter(source.read_block, None):
+        monitor.process_block(*block)
+        if monitor.n_received / monitor.sfreq >= next_report:
+            print(monitor.status(channel))
+            next_report += report_every
+    print(monitor.status(channel))
+    return monitor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='online ERP monitor for the elevation experiment')
+    parser.add_argument('--replay', type=pathlib.Path, help='replay this .vhdr file instead of listening')
+    parser.add_argument('--realtime', action='store_true', help='replay at the pace of the recording')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--header', type=pathlib.Path, help='.vhdr with the channel setup of the stream '
+                        '(required without --replay)')
+    parser.add_argument('--block-size', type=int, default=50, help='samples per block (replay)')
+    parser.add_argument('--channel', default='Cz')
+    args = parser.parse_args()
+    if args.replay is None and args.header is None:
+        parser.error('--header is required to listen on a socket')
+    mapping = default_registry.mapping()
+    if args.replay is not None:
+        stream = FileReplaySource(args.replay, args.block_size, mapping, args.realtime)
+    else:
+        stream = SocketSource(*stream_setup(args.header, mapping), args.port)
+    run_monitor(stream, channel=args.channel)
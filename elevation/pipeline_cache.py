@@ -0,0 +1,212 @@
+"""
+On-disk cache of the preprocessing chain (load -> filter -> events -> epochs -> re-reference): every stage is
+keyed by its parameters and the keys of its inputs, so changing a parameter recomputes only the stages after it.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import warnings
+import mne
+import numpy as np
+from brainvision_io import read_events, read_vhdr
+from filtering import decimate_events, filter_decimate_raw
+from montage_registry import default_registry
+from profiling import stage as profile_stage
+from rejection import apply_rejection
+
+DIR = pathlib.Path(__file__).resolve().parent.parent
+event_id = dict(up=1, down=2, left=3, right=4, front=5)  # trigger numbers of the elevation experiment
+
+_suffixes = dict(raw='_raw.fif', epochs='-epo.fif', events='-eve.npy')
+
+
+def file_hash(*paths, chunk_size=2 ** 22):
+    """ sha1 over the contents of all files """
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def brainvision_files(vhdr_path):
+    """ the .vhdr file and the .vmrk / .eeg files it refers to """
+    vhdr_path = pathlib.Path(vhdr_path)
+    files = [vhdr_path]
+    with open(vhdr_path, 'r', encoding='latin-1') as f:
+        for line in f:
+            if line.startswith(('DataFile=', 'MarkerFile=')):
+                files.append(vhdr_path.parent / line.split('=', 1)[1].strip())
+    return files
+
+
+def stage_key(name, params, *parent_keys):
+    text = json.dumps([name, params, parent_keys], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def data_key(params, data, *extra):
+    """ short sha1 of the json-able params, the bytes of the data array and json-able extras (e.g. channel names) """
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    h.update(np.ascontiguousarray(data).tobytes())
+    for item in extra:
+        h.update(json.dumps(item).encode())
+    return h.hexdigest()[:16]
+
+
+class CachedStage:
+    """ one step of the chain: compute(*input results) runs only if nothing is stored under the key """
+
+    def __init__(self, cache_dir, name, key, kind, compute, inputs=()):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.name, self.key, self.kind = name, key, kind
+        self._compute = compute
+        self._inputs = inputs
+        self._result = None
+
+    @property
+    def fname(self):
+        return self.cache_dir / f'{self.name}_{self.key[:16]}{_suffixes[self.kind]}'
+
+    @property
+    def cached(self):
+        return self._result is not None or self.fname.exists()
+
+    def get(self):
+        if self._result is None:
+            if self.fname.exists():
+                with profile_stage(self.name + ':load') as record:
+                    self._result = record.output(self._load())
+            else:
+                inputs = [stage.get() for stage in self._inputs]
+                with profile_stage(self.name) as record:
+                    for result in inputs:
+                        record.input(result)
+                    self._result = record.output(self._compute(*inputs))
+                with profile_stage(self.name + ':save'):
+                    self._save()
+        return self._result
+
+    def then(self, name, params, kind, func, *other_inputs):
+        """ new stage computing func(this result, *other results); func must not modify its inputs """
+        inputs = (self,) + other_inputs
+        key = stage_key(name, params, *[stage.key for stage in inputs])
+        return CachedStage(self.cache_dir, name, key, kind, func, inputs)
+
+    def _load(self):
+        if self.kind == 'raw':
+            return mne.io.read_raw_fif(self.fname, preload=True)
+        elif self.kind == 'epochs':
+            return mne.read_epochs(self.fname, preload=True)
+        return np.load(self.fname)
+
+    def _save(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write next to the final file and rename, so interrupted runs don't leave broken cache entries
+        tmp = self.fname.with_name('tmp_' + self.fname.name)
+        if self.kind == 'events':
+            with open(tmp, 'wb') as f:
+                np.save(f, self._result)
+        else:
+            self._result.save(tmp, overwrite=True)
+        os.replace(tmp, self.fname)
+
+
+def load_stage(vhdr_path, cache_dir, mapping_path=DIR / 'channel_mapping.pkl',
+               montage_path=DIR / 'AS-96_REF_c.bvef', ref_channel='FCz'):
+    """ first stage: read the recording, rename channels, add the reference channel and set the montage """
+    params = dict(data=file_hash(*brainvision_files(vhdr_path)), mapping=file_hash(mapping_path),
+                  montage=file_hash(montage_path), ref_channel=ref_channel)
+
+    def compute():
+        raw = mne.io.read_raw_brainvision(vhdr_path, preload=True)
+        raw.rename_channels(default_registry.mapping(mapping_path))
+        if ref_channel is not None:
+            raw = mne.add_reference_channels(raw, ref_channel, copy=False)
+        raw.set_montage(default_registry.montage(montage_path).to_mne())
+        return raw
+
+    return CachedStage(cache_dir, 'load', stage_key('load', params), 'raw', compute)
+
+
+def events_stage(vhdr_path, cache_dir, event_id=event_id, latency=0., timing_log=None, max_residual=10.):
+    """
+    events read directly from the .vmrk file (no raw data needed), checked against event_id and shifted by the
+    hardware latency in seconds; with timing_log (the .tlog of the block) trials whose marker is more than
+    max_residual ms off the logged onset are dropped (see trial_timing.marker_outliers)
+    """
+    common = read_vhdr(vhdr_path)['Common Infos']
+    vmrk_path = pathlib.Path(vhdr_path).parent / common['MarkerFile']
+    params = dict(markers=file_hash(vmrk_path), event_id=event_id, latency=latency,
+                  timing_log=file_hash(timing_log) if timing_log is not None else None,
+                  max_residual=max_residual if timing_log is not None else None)
+
+    def compute():
+        events = read_events(vhdr_path, event_id, latency=latency)
+        if timing_log is not None:
+            from trial_timing import marker_outliers
+            sfreq = 1e6 / float(common['SamplingInterval'])
+            outliers = marker_outliers(timing_log, read_events(vhdr_path), sfreq, max_residual)
+            if outliers.any():
+                warnings.warn(f'{vmrk_path.name}: dropped {outliers.sum()} events with markers more than '
+                              f'{max_residual} ms off the timing log')
+            events = events[~outliers]
+        return events
+
+    return CachedStage(cache_dir, 'events', stage_key('events', params), 'events', compute)
+
+
+def _make_epochs(raw, events, event_id, tmin, tmax, reject, flat, baseline, flat_exclude):
+    raw = raw.copy()
+    raw.info['bads'] += [ch for ch in flat_exclude if ch not in raw.info['bads']]  # e.g. exclude FCz from flat criteria
+    epochs = mne.Epochs(raw, events, event_id, tmin=tmin, tmax=tmax, reject=reject, flat=flat,
+                        baseline=baseline, reject_by_annotation=False, preload=True)
+    epochs.info['bads'] = []
+    return epochs
+
+
+def _eeg_threshold(spec):
+    # mne style dict(eeg=200e-6) -> 200e-6, other thresholds are passed on as they are
+    return spec['eeg'] if isinstance(spec, dict) and set(spec) == {'eeg'} else spec
+
+
+def preprocessing_chain(vhdr_path, cache_dir, l_freq=0.5, h_freq=40, event_id=event_id, tmin=-0.2, tmax=0.4,
+                        reject=dict(eeg=200e-6), flat=dict(eeg=2e-6), baseline=(None, 0), flat_exclude=('FCz',),
+                        reference='average', sfreq_new=None, bad_channel_share=None, latency=0., timing_log=None,
+                        **load_kwargs):
+    """
+    Cached eeg_pipeline.py prefix as a dict of stages ('raw', 'filtered', 'events', 'epochs', 'referenced'; .get()).
+    sfreq_new: also decimate in the filter stage. bad_channel_share: reject with rejection.apply_rejection instead.
+    """
+    raw = load_stage(vhdr_path, cache_dir, **load_kwargs)
+    sfreq = 1e6 / float(read_vhdr(vhdr_path)['Common Infos']['SamplingInterval'])
+    if sfreq_new is None:
+        filtered = raw.then('filter', dict(l_freq=l_freq, h_freq=h_freq), 'raw',
+                            lambda raw: raw.copy().filter(l_freq=l_freq, h_freq=h_freq))
+        events = events_stage(vhdr_path, cache_dir, event_id, latency, timing_log)
+    else:
+        filtered = raw.then('filter', dict(l_freq=l_freq, h_freq=h_freq, sfreq_new=sfreq_new), 'raw',
+                            lambda raw: filter_decimate_raw(raw, l_freq, h_freq, sfreq_new))
+        events = events_stage(vhdr_path, cache_dir, event_id, latency, timing_log).then(
+            'decimate_events', dict(sfreq_new=sfreq_new), 'events',
+            lambda events, filtered: decimate_events(events, int(round(sfreq / sfreq_new)), filtered.n_times),
+            filtered)
+    if bad_channel_share is None:
+        epochs = filtered.then('epochs', dict(event_id=event_id, tmin=tmin, tmax=tmax, reject=reject, flat=flat,
+                                              baseline=baseline, flat_exclude=list(flat_exclude)), 'epochs',
+                               lambda raw, events: _make_epochs(raw, events, event_id, tmin, tmax, reject, flat,
+                                                                baseline, list(flat_exclude)), events)
+    else:
+        epochs = filtered.then('epochs', dict(event_id=event_id, tmin=tmin, tmax=tmax, reject=None, flat=None,
+                                              baseline=baseline, flat_exclude=[]), 'epochs',
+                               lambda raw, events: _make_epochs(raw, events, event_id, tmin, tmax, None, None,
+                                                                baseline, []), events)
+        epochs = epochs.then('reject', dict(reject=reject, flat=flat, flat_exclude=list(flat_exclude),
+                                            bad_channel_share=bad_channel_share), 'epochs',
+                             lambda epochs: apply_rejection(epochs.copy(), _eeg_threshold(reject), _eeg_threshold(flat),
+                                                            flat_exclude, bad_channel_share)[0])
+    referenced = epochs.then('reference', dict(reference=reference), 'epochs',
+                             lambda epochs: epochs.copy().set_eeg_reference(reference))
+    return dict(raw=raw, filtered=filtered, events=events, epochs=epochs, referenced=referenced)
@@ -0,0 +1,237 @@
+"""
+Per-stage wall / CPU time, memory and data size of pipeline runs, one json line per stage in a run log:
+    configure(eeg_DIR / 'run_log.jsonl', subject='vanessa')  # off (and almost free) until configured
+    with stage('save') as record:
+        record.input(epochs)
+        epochs.save(fname)
+    python elevation/profiling.py elevation/data/run_log.jsonl  # time and memory per stage over all runs
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import pathlib
+import sys
+import time
+import tracemalloc
+import numpy as np
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def _rss():
+    """ current resident set size in bytes (None where /proc isn't available) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss():
+    """ peak resident set size of the process in bytes """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macos, kilobytes on linux
+
+
+def describe(obj):
+    """ size of an array, mne Raw / Epochs / Evoked (channels, samples or epochs, dtype, bytes) or None """
+    if isinstance(obj, np.ndarray):
+        return dict(type='array', shape=list(obj.shape), dtype=str(obj.dtype), bytes=obj.nbytes)
+    data = getattr(obj, '_data', None)
+    if isinstance(data, np.ndarray) and hasattr(obj, 'info'):
+        size = dict(type=type(obj).__name__, n_channels=len(obj.ch_names), dtype=str(data.dtype), bytes=data.nbytes)
+        if data.ndim == 3:
+            size.update(n_epochs=data.shape[0], n_times=data.shape[2])
+        else:
+            size.update(n_samples=data.shape[-1])
+        return size
+    if hasattr(obj, 'n_components_') and hasattr(obj, 'ch_names'):  # fitted ICA
+        return dict(type=type(obj).__name__, n_channels=len(obj.ch_names), n_components=int(obj.n_components_))
+    if isinstance(obj, tuple) and obj:
+        return describe(obj[0])
+    return None
+
+
+class _Stage:
+    """ measurements of one running stage; record.input(obj) / record.output(obj) add data sizes """
+
+    def __init__(self, profiler, name, fields):
+        self.profiler = profiler
+        self.record = dict(subject=profiler.subject, stage=name, **fields)
+        self._peak = 0
+
+    def input(self, obj):
+        size = describe(obj)
+        if size is not None:
+            self.record.setdefault('inputs', []).append(size)
+        return obj
+
+    def output(self, obj):
+        size = describe(obj)
+        if size is not None:
+            self.record['output'] = size
+        return obj
+
+    def __enter__(self):
+        stack = self.profiler._stack
+        self.record.update(parent=stack[-1].record['stage'] if stack else None, pid=os.getpid(),
+                           time=datetime.datetime.now().isoformat(timespec='milliseconds'))
+        if self.profiler.trace_memory:
+            if stack:  # the parent's peak so far, before the peak is reset for this stage
+                stack[-1]._peak = max(stack[-1]._peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._traced_start = tracemalloc.get_traced_memory()[0]
+        stack.append(self)
+        self._rss_start, self._peak_rss_start = _rss(), _peak_rss()
+        self._cpu_start, self._wall_start = time.process_time(), time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall, cpu = time.perf_counter() - self._wall_start, time.process_time() - self._cpu_start
+        stack = self.profiler._stack
+        stack.pop()
+        peak_rss = _peak_rss()
+        self.record.update(wall=wall, cpu=cpu, rss_start=self._rss_start, rss_end=_rss(), peak_rss=peak_rss,
+                           peak_rss_increase=None if peak_rss is None else peak_rss - self._peak_rss_start)
+        if self.profiler.trace_memory:
+            peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            self.record['traced_peak'] = peak - self._traced_start  # largest extra allocation during the stage
+            if stack:
+                stack[-1]._peak = max(stack[-1]._peak, peak)
+        if exc_type is not None:
+            self.record['error'] = repr(exc)
+        self.profiler._emit(self.record)
+        return False
+
+
+class _NullStage:
+    # returned while profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def input(self, obj):
+        return obj
+
+    def output(self, obj):
+        return obj
+
+
+_null_stage = _NullStage()
+
+
+class Profiler:
+    """ stage records, also appended to log (one write per stage, workers can share it); trace_memory: tracemalloc """
+
+    def __init__(self, log=None, subject=None, enabled=True, trace_memory=False):
+        self.records = []
+        self._stack = []
+        self.configure(log, subject, enabled, trace_memory)
+
+    def configure(self, log=None, subject=None, enabled=True, trace_memory=False):
+        self.log = pathlib.Path(log) if log is not None else None
+        self.subject, self.enabled, self.trace_memory = subject, enabled, trace_memory
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not (enabled and trace_memory) and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name, **fields):
+        """ context manager that measures the code in it as one stage; fields are added to the record """
+        return _Stage(self, name, fields) if self.enabled else _null_stage
+
+    def _emit(self, record):
+        self.records.append(record)
+        if self.log is not None:
+            self.log.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+profiler = Profiler(enabled=False)  # used by the pipeline modules
+
+
+def configure(log=None, subject=None, enabled=True, trace_memory=False):
+    """ switch the profiling of the pipeline modules on (or off with enabled=False) """
+    profiler.configure(log, subject, enabled, trace_memory)
+
+
+def stage(name, **fields):
+    """ profiler.stage of the module-level profiler """
+    return profiler.stage(name, **fields)
+
+
+def profiled(name=None):
+    """ decorator: every call is a stage (default: the function name) with the first argument as input """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.stage(name or func.__name__) as record:
+                if args:
+                    record.input(args[0])
+                return record.output(func(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def read_run_log(fname):
+    """ all records of a run log """
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def aggregate(records, by='stage'):
+    """ time, share of the total and largest memory / output size per stage (or subject), slowest first """
+    total = sum(r['wall'] for r in records if r.get('parent') is None) or 1.
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get(by), []).append(record)
+
+    def largest(group, key):
+        values = [r[key] for r in group if r.get(key) is not None]
+        return max(values) if values else None
+
+    rows = []
+    for name, group in groups.items():
+        wall = np.array([r['wall'] for r in group])
+        rows.append(dict(name=name, n=len(group), subjects=len({r.get('subject') for r in group}),
+                         wall_total=wall.sum(), wall_mean=wall.mean(), wall_max=wall.max(),
+                         cpu_total=sum(r['cpu'] for r in group),
+                         share=sum(r['wall'] for r in group if r.get('parent') is None) / total,
+                         peak_rss=largest(group, 'peak_rss'), peak_rss_increase=largest(group, 'peak_rss_increase'),
+                         traced_peak=largest(group, 'traced_peak'),
+                         output_bytes=max([r['output']['bytes'] for r in group if 'bytes' in r.get('output', {})],
+                                          default=None)))
+    return sorted(rows, key=lambda row: row['wall_total'], reverse=True)
+
+
+def report(rows):
+    """ aggregate() rows as a text table (times in s, memory in MB) """
+    def mb(value):
+        return f'{value / 2 ** 20:9.1f}' if value is not None else f'{"-":>9}'
+
+    lines = [f'{"":>22} {"n":>5} {"total":>9} {"mean":>8} {"max":>8} {"cpu":>9} {"share":>6} {"peak RSS":>9} '
+             f'{"+peak":>9} {"traced":>9} {"output":>9}']
+    for row in rows:
+        lines.append(f'{str(row["name"]):>22} {row["n"]:5d} {row["wall_total"]:9.2f} {row["wall_mean"]:8.2f} '
+                     f'{row["wall_max"]:8.2f} {row["cpu_total"]:9.2f} {row["share"]:6.1%} {mb(row["peak_rss"])} '
+                     f'{mb(row["peak_rss_increase"])} {mb(row["traced_peak"])} {mb(row["output_bytes"])}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time and memory per pipeline stage from a run log')
+    parser.add_argument('log', type=pathlib.Path)
+    parser.add_argument('--by', default='stage', choices=('stage', 'subject'))
+    args = parser.parse_args()
+    print(report(aggregate(read_run_log(args.log), args.by)))
@@ -0,0 +1,101 @@
+"""
+Peak-to-peak epoch rejection with per-channel / per-condition thresholds and bad-channel detection.
+"""
+import mne
+import numpy as np
+from montage_registry import interpolate_bads
+from profiling import profiled
+
+# drop log codes
+OK, TOO_LARGE, TOO_FLAT = 0, 1, 2
+
+
+class RejectLog:
+    """ result of reject_epochs; drop_log and ptp are (epochs x channels), keep is the mask of kept epochs """
+
+    def __init__(self, drop_log, ch_names, bad_channels, keep, ptp):
+        self.drop_log, self.ch_names, self.bad_channels, self.keep, self.ptp = \
+            drop_log, ch_names, bad_channels, keep, ptp
+
+    @property
+    def dropped(self):
+        return np.flatnonzero(~self.keep)
+
+    def reasons(self):
+        """ per dropped epoch, the channels that caused the drop (the format of epochs.drop_log) """
+        good = ~np.isin(self.ch_names, self.bad_channels)
+        return [tuple(str(ch) for ch in np.asarray(self.ch_names)[(self.drop_log[i] != OK) & good])
+                for i in self.dropped]
+
+    def channel_share(self):
+        """ share of epochs in which each channel exceeds a threshold """
+        return (self.drop_log != OK).mean(axis=0)
+
+
+def _threshold_matrix(value, ch_names, codes, event_id, default):
+    """ (epochs x channels) thresholds from a scalar, {channel: value}, an array or {condition: any of these} """
+    n_epochs, n_channels = len(codes), len(ch_names)
+
+    def per_channel(spec):
+        if spec is None:
+            return np.full(n_channels, default)
+        if isinstance(spec, dict):
+            return np.array([spec.get(ch, default) for ch in ch_names], dtype=float)
+        return np.broadcast_to(np.asarray(spec, dtype=float), (n_channels,))
+
+    is_condition_dict = isinstance(value, dict) and value and \
+        all(key in (event_id or {}) or not isinstance(key, str) for key in value)
+    if not is_condition_dict:
+        return np.broadcast_to(per_channel(value), (n_epochs, n_channels))
+    matrix = np.broadcast_to(per_channel(None), (n_epochs, n_channels)).copy()
+    for condition, spec in value.items():
+        code = event_id[condition] if isinstance(condition, str) else condition
+        matrix[codes == code] = per_channel(spec)
+    return matrix
+
+
+def reject_epochs(data, ch_names, codes=None, event_id=None, reject=200e-6, flat=2e-6, flat_exclude=('FCz',),
+                  bad_channel_share=None):
+    """
+    peak-to-peak rejection of (epochs x channels x times) data; reject / flat as in _threshold_matrix (per condition
+    needs codes and event_id). Channels exceeding a threshold in more than bad_channel_share of the epochs are
+    returned as bad channels instead of dropping those epochs.
+    """
+    data = np.asarray(data)
+    codes = np.zeros(len(data), dtype=int) if codes is None else np.asarray(codes)
+    ptp = data.max(axis=-1) - data.min(axis=-1)  # epochs x channels
+    drop_log = np.zeros(ptp.shape, dtype=np.uint8)
+    if reject is not None:
+        drop_log[ptp > _threshold_matrix(reject, ch_names, codes, event_id, np.inf)] = TOO_LARGE
+    if flat is not None:
+        too_flat = ptp < _threshold_matrix(flat, ch_names, codes, event_id, -np.inf)
+        too_flat[:, np.isin(ch_names, flat_exclude)] = False
+        drop_log[too_flat & (drop_log == OK)] = TOO_FLAT
+    bad = drop_log != OK
+    bad_channels = []
+    if bad_channel_share is not None:
+        bad_channels = [ch for ch, share in zip(ch_names, bad.mean(axis=0)) if share > bad_channel_share]
+    keep = ~np.any(bad[:, ~np.isin(ch_names, bad_channels)], axis=1)
+    return RejectLog(drop_log, list(ch_names), bad_channels, keep, ptp)
+
+
+@profiled('rejection')
+def apply_rejection(epochs, reject=200e-6, flat=2e-6, flat_exclude=('FCz',), bad_channel_share=0.2,
+                    interpolate=True):
+    """ reject_epochs on mne Epochs (in place), bad channels are interpolated; returns (epochs, RejectLog) """
+    picks = mne.pick_types(epochs.info, eeg=True, exclude=[])
+    ch_names = [epochs.ch_names[i] for i in picks]
+    log = reject_epochs(epochs.get_data(picks=picks), ch_names, epochs.events[:, 2], epochs.event_id,
+                        reject, flat, flat_exclude, bad_channel_share)
+    if log.bad_channels:
+        epochs.info['bads'] += [ch for ch in log.bad_channels if ch not in epochs.info['bads']]
+        if interpolate:
+            interpolate_bads(epochs, reset_bads=True)  # cached spline matrix per bad-channel set
+    selection = epochs.selection[log.dropped]
+    epochs.drop(log.dropped, reason='PTP')
+    # one drop_log entry per epoch with the channels that caused it, as mne's own rejection does
+    drop_log = list(epochs.drop_log)
+    for idx, reason in zip(selection, log.reasons()):
+        drop_log[idx] = reason
+    epochs.drop_log = tuple(drop_log)
+    return epochs, log
@@ -0,0 +1,261 @@
+"""
+Figures of every subject and of the grand average rendered headless (Agg) in parallel, with an index.html:
+    python elevation/report.py --workers 4  # all <subject>-epo.fif in elevation/data -> elevation/data/report
+    python elevation/report.py --subjects leonie sophie --topomap-times 0 0.4 0.01 --figures erp topomaps
+"""
+import argparse
+import json
+import multiprocessing
+import pathlib
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use('Agg')  # before pyplot / mne.viz are imported
+from matplotlib import pyplot as plt
+import mne
+import numpy as np
+from epoch_store import EpochStore
+from group_erp import ERPAccumulator, event_id
+from montage_registry import MontageRegistry
+
+DIR = pathlib.Path(__file__).resolve().parent.parent
+eeg_DIR = DIR / 'elevation' / 'data'
+subject_figures = ('drop_log', 'erp', 'difference', 'topomaps', 'ica_components')
+group_figures = ('erp', 'difference', 'topomaps', 'clusters')
+_registry = None  # per process, with the disk cache of the report
+
+
+def _get_registry(cache_dir):
+    global _registry
+    if _registry is None:
+        _registry = MontageRegistry(cache_dir=cache_dir)
+    return _registry
+
+
+def plot_topomaps(evokeds, times, grid, vlim=None, cmap='RdBu_r', n_contours=6, size=1.2):
+    """ topomaps of {title: Evoked} (rows) at times (columns) from one TopomapGrid; vlim in µV """
+    times = np.atleast_1d(times)
+    fig, axes = plt.subplots(len(evokeds), len(times), figsize=(size * len(times) + 1, size * len(evokeds) + 0.5),
+                             squeeze=False)
+    images = {}
+    for title, evoked in evokeds.items():
+        picks = [evoked.ch_names.index(ch) for ch in grid.ch_names]
+        samples = [evoked.time_as_index(t)[0] for t in times]
+        images[title] = grid.images(evoked.data[np.ix_(picks, samples)] * 1e6)
+    vlim = vlim or max(np.nanmax(np.abs(image)) for image in images.values())
+    levels = np.linspace(-vlim, vlim, n_contours + 2)[1:-1]
+    for row, (title, image) in enumerate(images.items()):
+        for col, t in enumerate(times):
+            ax = axes[row, col]
+            im = ax.imshow(image[..., col], origin='lower', extent=grid.extent, cmap=cmap, vmin=-vlim, vmax=vlim,
+                           interpolation='bilinear')
+            ax.contour(image[..., col], levels, extent=grid.extent, colors='k', linewidths=0.3)
+            ax.add_patch(plt.Circle((0, 0), 1, fill=False, lw=0.8))  # head
+            ax.plot([-0.1, 0, 0.1], [0.99, 1.12, 0.99], 'k', lw=0.8)  # nose
+            ax.plot(*grid.coords.T, 'k.', ms=0.8)
+            ax.set_xlim(-grid.radius, grid.radius)
+            ax.set_ylim(-grid.radius, grid.radius * 1.05)
+            ax.set_axis_off()
+            if row == 0:
+                ax.set_title(f'{t * 1e3:.0f} ms', fontsize=7)
+        axes[row, 0].text(-grid.radius * 1.1, 0, title, rotation=90, ha='right', va='center', fontsize=8)
+    fig.colorbar(im, ax=axes, shrink=0.6, label='µV')
+    return fig
+
+
+def _plot_difference(differences, sems, times, channel, title):
+    # difference waves with standard error band at one channel
+    fig, ax = plt.subplots(figsize=(7, 4))
+    for name, evoked in differences.items():
+        ch = evoked.ch_names.index(channel)
+        line, = ax.plot(times * 1e3, evoked.data[ch] * 1e6, label=name)
+        if sems.get(name) is not None:
+            ax.fill_between(times * 1e3, (evoked.data[ch] - sems[name][ch]) * 1e6,
+                            (evoked.data[ch] + sems[name][ch]) * 1e6, color=line.get_color(), alpha=0.2)
+    ax.axhline(0, color='k', lw=0.5)
+    ax.axvline(0, color='k', lw=0.5)
+    ax.set(xlabel='time (ms)', ylabel='µV', title=title)
+    ax.legend()
+    return fig
+
+
+def _save(fig, fname, dpi):
+    fig.savefig(fname, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return fname.name
+
+
+def _latest_ica(cache_dir, subject):
+    files = sorted(pathlib.Path(cache_dir).glob(f'{subject}_*-ica.fif'), key=lambda f: f.stat().st_mtime)
+    return mne.preprocessing.read_ica(files[-1], verbose='error') if files else None
+
+
+def render_subject(subject, data_dir=eeg_DIR, out_dir=None, figures=subject_figures, times=None, channel='FCz',
+                   standard='front', cache_dir=None, dpi=100):
+    """ {figure: file} of the figures of one subject in out_dir/<subject> (those that can be made) """
+    data_dir = pathlib.Path(data_dir)
+    cache_dir = cache_dir or data_dir / 'cache'
+    out = pathlib.Path(out_dir or data_dir / 'report') / subject
+    out.mkdir(parents=True, exist_ok=True)
+    epochs = mne.read_epochs(data_dir / f'{subject}-epo.fif', preload=True, verbose='error')
+    conditions = [name for name in epochs.event_id if len(epochs[name])]
+    evokeds = {name: epochs[name].average() for name in conditions}
+    deviants = [name for name in conditions if name != standard]
+    files = {}
+    if 'drop_log' in figures:
+        files['drop_log'] = _save(epochs.plot_drop_log(subject=subject, show=False), out / 'drop_log.png', dpi)
+    if 'erp' in figures:
+        fig = mne.viz.plot_compare_evokeds(evokeds, picks=channel, show=False, title=f'{subject} {channel}')[0]
+        files['erp'] = _save(fig, out / 'erp.png', dpi)
+    differences = {f'{name} - {standard}': mne.combine_evoked([evokeds[name], evokeds[standard]], [1, -1])
+                   for name in deviants if standard in evokeds}
+    if 'difference' in figures and differences:
+        fig = _plot_difference(differences, {}, epochs.times, channel, f'{subject} {channel}')
+        files['difference'] = _save(fig, out / 'difference.png', dpi)
+    if 'topomaps' in figures and differences:
+        grid = _get_registry(cache_dir).topomap_grid(epochs.info)
+        fig = plot_topomaps(differences, _topomap_times(times, epochs.times), grid)
+        files['topomaps'] = _save(fig, out / 'topomaps.png', dpi)
+    if 'ica_components' in figures:
+        ica = _latest_ica(cache_dir, subject)
+        if ica is not None:
+            figs = ica.plot_components(inst=None, show=False)
+            for i, fig in enumerate(figs if isinstance(figs, list) else [figs]):
+                files[f'ica_components_{i}'] = _save(fig, out / f'ica_components_{i}.png', dpi)
+    return files
+
+
+def render_group(subjects, data_dir=eeg_DIR, out_dir=None, figures=group_figures, times=None, channel='FCz',
+                 standard='front', cache_dir=None, dpi=100, n_permutations=1000, n_jobs=1):
+    """ {figure: file} of the grand average figures in out_dir/grand_average (epoch store, else -epo.fif) """
+    data_dir = pathlib.Path(data_dir)
+    cache_dir = cache_dir or data_dir / 'cache'
+    out = pathlib.Path(out_dir or data_dir / 'report') / 'grand_average'
+    out.mkdir(parents=True, exist_ok=True)
+    erps = ERPAccumulator(event_id, standard=standard)
+    store = EpochStore(data_dir / 'epoch_store')
+    stored = [subject for subject in subjects if subject in store.subjects] if store.meta is not None else []
+    if stored:
+        erps.add_store(store, stored)
+    for subject in subjects:
+        if subject not in stored:
+            erps.add_file(data_dir / f'{subject}-epo.fif', subject)
+    deviants = [name for name in erps.differences if name != standard]
+    differences = {f'{name} - {standard}': erps.difference_wave(name) for name in deviants}
+    files = {}
+    if 'erp' in figures:
+        evokeds = {name: erps.grand_average(name) for name in erps.trials}
+        fig = mne.viz.plot_compare_evokeds(evokeds, picks=channel, show=False,
+                                           title=f'grand average {channel} (n={len(subjects)})')[0]
+        files['erp'] = _save(fig, out / 'erp.png', dpi)
+    if 'difference' in figures and differences:
+        sems = {f'{name} - {standard}': erps.difference_sem(name) if len(subjects) > 1 else None
+                for name in deviants}
+        fig = _plot_difference(differences, sems, erps.times, channel, f'grand average {channel} (± sem)')
+        files['difference'] = _save(fig, out / 'difference.png', dpi)
+    if 'topomaps' in figures and differences:
+        grid = _get_registry(cache_dir).topomap_grid(erps.info)
+        fig = plot_topomaps(differences, _topomap_times(times, erps.times), grid)
+        files['topomaps'] = _save(fig, out / 'topomaps.png', dpi)
+    if 'clusters' in figures and len(subjects) > 1:
+        from cluster_stats import deviant_clusters
+        results = deviant_clusters(erps, deviants, n_permutations=n_permutations, n_jobs=n_jobs)
+        for deviant, result in results.items():
+            fig = erps.difference_wave(deviant).plot_image(mask=result.mask(), titles=f'{deviant} - {standard}',
+                                                          show=False)
+            files[f'clusters_{deviant}'] = _save(fig, out / f'clusters_{deviant}.png', dpi)
+    return files
+
+
+def _topomap_times(times, epoch_times):
+    # (start, stop, step) in seconds, a list of times, or 25 ms steps over the post-stimulus period
+    if times is None:
+        return np.arange(0., epoch_times[-1] + 1e-9, 0.025)
+    if isinstance(times, tuple) and len(times) == 3:
+        return np.arange(times[0], times[1] + 1e-9, times[2])
+    return np.asarray(times)
+
+
+def _render(kind, subject, kwargs):
+    start = time.perf_counter()
+    try:
+        files = render_subject(subject, **kwargs) if kind == 'subject' else render_group(subject, **kwargs)
+        summary = dict(status='ok', files=files)
+    except Exception as error:
+        summary = dict(status='failed', error=repr(error), traceback=traceback.format_exc())
+    summary['duration'] = time.perf_counter() - start
+    return kind, subject, summary
+
+
+def _write_index(out_dir, results):
+    sections = []
+    for name, summary in results.items():
+        folder = 'grand_average' if name == 'grand average' else name
+        images = ''.join(f'<figure><img src="{folder}/{fname}"><figcaption>{figure}</figcaption></figure>\n'
+                         for figure, fname in summary.get('files', {}).items())
+        sections.append(f'<h2>{name}</h2>\n' + (images or f'<p>{summary.get("error", "no figures")}</p>\n'))
+    (out_dir / 'index.html').write_text('<html><head><meta charset="utf-8"><title>elevation report</title><style>'
+                                        'img{max-width:900px}figure{display:inline-block}</style></head><body>\n'
+                                        + ''.join(sections) + '</body></html>\n', encoding='utf-8')
+
+
+def render_report(data_dir=eeg_DIR, out_dir=None, subjects=None, n_workers=1, figures=None, times=None,
+                  channel='FCz', standard='front', dpi=100, group=True, n_permutations=1000):
+    """
+    render the subject figures in n_workers processes and the grand average figures, write report.json and
+    index.html to out_dir; returns the summary
+    """
+    data_dir = pathlib.Path(data_dir)
+    out_dir = pathlib.Path(out_dir or data_dir / 'report')
+    out_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir = data_dir / 'cache'
+    if subjects is None:
+        subjects = sorted(f.name[:-len('-epo.fif')] for f in data_dir.glob('*-epo.fif'))
+    kwargs = dict(data_dir=data_dir, out_dir=out_dir, times=times, channel=channel, standard=standard,
+                  cache_dir=cache_dir, dpi=dpi)
+    subject_kwargs = dict(kwargs, figures=[f for f in figures or subject_figures if f in subject_figures])
+    group_kwargs = dict(kwargs, figures=[f for f in figures or group_figures if f in group_figures],
+                        n_permutations=n_permutations)
+    if subjects:
+        # compute the topomap grid once, the workers load it from the cache
+        info = mne.read_epochs(data_dir / f'{subjects[0]}-epo.fif', preload=False, verbose='error').info
+        _get_registry(cache_dir).topomap_grid(info)
+    results = {}
+    tasks = [('subject', subject, subject_kwargs) for subject in subjects]
+    if group and subjects:
+        tasks.append(('group', list(subjects), group_kwargs))
+    # spawn: fresh workers without the state (or a display connection) of the parent
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_render, *task) for task in tasks]
+        for future in as_completed(futures):
+            kind, subject, summary = future.result()
+            name = subject if kind == 'subject' else 'grand average'
+            results[name] = summary
+            print(f"{name}: {summary['status']} ({summary['duration']:.1f} s)")
+    results = {name: results[name] for name in list(subjects) + ['grand average'] if name in results}
+    with open(out_dir / 'report.json', 'w') as f:
+        json.dump(results, f, indent=2)
+    _write_index(out_dir, results)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render the figures of the elevation analysis to files')
+    parser.add_argument('--data-dir', type=pathlib.Path, default=eeg_DIR)
+    parser.add_argument('--out', type=pathlib.Path, help='output folder (default: <data-dir>/report)')
+    parser.add_argument('--subjects', nargs='*', help='default: all subjects with a -epo.fif file')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--figures', nargs='*', choices=sorted(set(subject_figures + group_figures)))
+    parser.add_argument('--topomap-times', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'),
+                        help='topomap times in seconds (default: 0 to the epoch end in 25 ms steps)')
+    parser.add_argument('--channel', default='FCz')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--no-group', action='store_true', help='skip the grand average figures')
+    parser.add_argument('--permutations', type=int, default=1000, help='permutations of the cluster test')
+    args = parser.parse_args()
+    results = render_report(args.data_dir, args.out, args.subjects, args.workers, args.figures,
+                            tuple(args.topomap_times) if args.topomap_times else None, args.channel, dpi=args.dpi,
+                            group=not args.no_group, n_permutations=args.permutations)
+    n_failed = sum(summary['status'] != 'ok' for summary in results.values())
+    print(f'{len(results) - n_failed} reports rendered, {n_failed} failed')
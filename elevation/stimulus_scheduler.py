@@ -0,0 +1,255 @@
+"""
+Trial scheduling at a fixed stimulus onset asynchrony: stimuli are uploaded once, per trial only changed speaker
+channels and trigger codes are written, during the silence after the stimulus:
+    backend = FreefieldBackend(setup='dome', default='play_rec')  # or MockBackend() without the hardware
+    bank = StimulusBank(backend)
+    bank.add('noise', stim)  # the stimulus only, the silence between stimuli is made by the scheduler
+    onsets = TrialScheduler(backend, bank, soa=0.6).run([('noise', 23, 5), ('noise', 20, 1), ...])
+    python elevation/stimulus_scheduler.py  # compare with the per-trial upload loop on the mock backend
+"""
+import argparse
+import time
+import numpy as np
+
+
+class FreefieldBackend:
+    """
+    the TDT processors of the dome, through freefield (kwargs are passed to freefield.initialize);
+    samplerate is the rate of the RP2 / RX8 circuits
+    """
+
+    def __init__(self, setup='dome', default='play_rec', initialize=True, data_tag='data', chan_tag='chan',
+                 n_samples_tag='playbuflen', samplerate=48828, **kwargs):
+        import freefield
+        self.freefield = freefield
+        if initialize:
+            freefield.initialize(setup=setup, default=default, **kwargs)
+            freefield.set_logger('warning')
+        self.data_tag, self.chan_tag, self.n_samples_tag = data_tag, chan_tag, n_samples_tag
+        self.samplerate = samplerate
+        # initialize() fills the table of the freefield.freefield module, freefield.SPEAKERS is bound at import
+        self.analog_processors = sorted({speaker.analog_proc for speaker in freefield.freefield.SPEAKERS})
+        if not self.analog_processors:
+            raise RuntimeError('the freefield speaker table is empty, initialize freefield first')
+
+    def speaker(self, index):
+        """ (processor, analog channel) of a speaker index """
+        speaker = self.freefield.pick_speakers(index)[0]
+        return speaker.analog_proc, speaker.analog_channel
+
+    def write(self, tag, value, processors):
+        self.freefield.write(tag=tag, value=value, processors=processors)
+
+    def play(self):
+        self.freefield.play()
+
+    def wait_to_finish(self):
+        self.freefield.wait_to_finish_playing()
+
+    def wait_for_button(self):
+        self.freefield.wait_for_button()
+
+
+class MockBackend:
+    """
+    stand-in for the processors: every call costs latency (+ jitter) seconds, uploads one more second per
+    upload_rate values; speakers 0-23 are on RX81, 24-46 on RX82. Calls are logged as (time, call, tag).
+    """
+
+    def __init__(self, samplerate=48828, latency=2e-3, jitter=0.5e-3, upload_rate=2e6, seed=0,
+                 data_tag='data', chan_tag='chan', n_samples_tag='playbuflen'):
+        self.samplerate, self.latency, self.jitter, self.upload_rate = samplerate, latency, jitter, upload_rate
+        self.data_tag, self.chan_tag, self.n_samples_tag = data_tag, chan_tag, n_samples_tag
+        self.analog_processors = ['RX81', 'RX82']
+        self._rng = np.random.default_rng(seed)
+        self._n_samples = 0
+        self._end = 0.
+        self.log = []
+
+    def _round_trip(self, n_values=1):
+        # busy-wait: the simulated latencies shouldn't depend on the precision of time.sleep
+        delay = max(0., self.latency + self._rng.normal(0, self.jitter)) + n_values / self.upload_rate
+        end = time.perf_counter() + delay
+        while time.perf_counter() < end:
+            pass
+
+    def speaker(self, index):
+        return ('RX81', index % 24 + 1) if index < 24 else ('RX82', index % 24 + 1)
+
+    def write(self, tag, value, processors):
+        processors = [processors] if isinstance(processors, str) else processors
+        for _ in processors:
+            self._round_trip(np.size(value))
+        if tag == self.n_samples_tag:
+            self._n_samples = int(value)
+        self.log.append((time.perf_counter(), 'write', tag))
+
+    def play(self):
+        self._round_trip()
+        now = time.perf_counter()
+        self._end = now + self._n_samples / self.samplerate
+        self.log.append((now, 'play', None))
+
+    def wait_to_finish(self):
+        # polls the playback tag until the buffer is done
+        self._round_trip()
+        while time.perf_counter() < self._end:
+            self._round_trip()
+
+    def wait_for_button(self):
+        pass
+
+
+class StimulusBank:
+    """ stimuli by name, uploaded only when a different stimulus was played before """
+
+    def __init__(self, backend, n_samples_processors=None):
+        self.backend = backend
+        self.n_samples_processors = n_samples_processors or backend.analog_processors
+        self.stimuli = {}
+        self.loaded = None
+        self.n_uploads = 0
+
+    def add(self, name, stimulus):
+        self.stimuli[name] = stimulus
+
+    def duration(self, name):
+        stimulus = self.stimuli[name]
+        if hasattr(stimulus, 'duration'):
+            return stimulus.duration
+        return len(stimulus) / self.backend.samplerate
+
+    def load(self, name):
+        if self.loaded == name:
+            return
+        stimulus = self.stimuli[name]
+        data = np.asarray(stimulus.data if hasattr(stimulus, 'data') else stimulus).ravel()
+        self.backend.write(self.backend.n_samples_tag, len(data), self.n_samples_processors)
+        self.backend.write(self.backend.data_tag, data, self.backend.analog_processors)
+        self.loaded = name
+        self.n_uploads += 1
+
+
+class TrialScheduler:
+    """ plays (stimulus name, speaker index, trigger code) trials every soa seconds, skipping unchanged writes """
+
+    def __init__(self, backend, bank, soa=0.6, trigger_tag='trigcode', trigger_processor='RX82', lead=0.1,
+                 spin=2e-3):
+        self.backend, self.bank, self.soa = backend, bank, soa
+        self.trigger_tag, self.trigger_processor = trigger_tag, trigger_processor
+        self.lead = lead  # time between the first writes and the first onset
+        self.spin = spin  # the last part of every wait is busy-waiting, sleep isn't precise enough
+        self._values = {}  # (tag, processor): value last written
+        self._speakers = {}
+
+    def _prepare(self, trial):
+        """ the (tag, value, processor) writes that set up a trial """
+        name, speaker, code = trial
+        if speaker not in self._speakers:
+            self._speakers[speaker] = self.backend.speaker(speaker)
+        proc, channel = self._speakers[speaker]
+        writes = [(self.backend.chan_tag, channel if p == proc else 99, p) for p in self.backend.analog_processors]
+        writes.append((self.trigger_tag, code, self.trigger_processor))
+        return name, [w for w in writes if self._values.get(w[::2]) != w[1]]
+
+    def _apply(self, prepared):
+        name, writes = prepared
+        self.bank.load(name)
+        for tag, value, proc in writes:
+            if self._values.get((tag, proc)) != value:
+                self.backend.write(tag, value, proc)
+                self._values[(tag, proc)] = value
+
+    def _wait_until(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.perf_counter() < deadline:
+            pass
+
+    def run(self, trials, on_trial=None, pause_every=None, on_pause=None):
+        """
+        play all trials and return their onsets (perf_counter); on_trial(n, trial) runs after every onset,
+        on_pause() (e.g. wait for the button) every pause_every trials
+        """
+        trials = list(trials)
+        onsets = np.zeros(len(trials))
+        prepared = self._prepare(trials[0])
+        self._apply(prepared)
+        deadline = time.perf_counter() + self.lead
+        for n, trial in enumerate(trials):
+            self._wait_until(deadline)
+            self.backend.play()
+            onsets[n] = time.perf_counter()
+            if on_trial is not None:
+                on_trial(n, trial)
+            if n + 1 == len(trials):
+                break
+            prepared = self._prepare(trials[n + 1])
+            # only touch the processors once the stimulus is over
+            self._wait_until(onsets[n] + self.bank.duration(trial[0]))
+            self.backend.wait_to_finish()
+            if pause_every and (n + 1) % pause_every == 0:
+                if on_pause is not None:
+                    on_pause()
+                self._apply(prepared)
+                deadline = time.perf_counter() + self.lead
+            else:
+                self._apply(prepared)
+                deadline = max(deadline + self.soa, time.perf_counter())  # late onsets don't shift the rest
+        return onsets
+
+
+def timing_summary(onsets, soa):
+    """ mean, standard deviation, median and largest deviation from soa of the onset intervals, in ms """
+    intervals = np.diff(onsets)
+    return dict(mean_soa=intervals.mean() * 1e3, jitter_sd=intervals.std() * 1e3,
+                median_deviation=np.median(np.abs(intervals - soa)) * 1e3,
+                max_deviation=np.abs(intervals - soa).max() * 1e3)
+
+
+def per_trial_upload_loop(backend, trials, stimuli, isi=0.5):
+    """ the old loop of elevation_eeg.py (upload stimulus + silence, trigger, play, wait) for comparison """
+    onsets = np.zeros(len(trials))
+    for n, (name, speaker, code) in enumerate(trials):
+        sequence = np.concatenate([stimuli[name], np.zeros(int(isi * backend.samplerate))])
+        proc, channel = backend.speaker(speaker)
+        backend.write(backend.n_samples_tag, len(sequence), backend.analog_processors)
+        backend.write(backend.data_tag, sequence, proc)
+        for p in backend.analog_processors:
+            backend.write(backend.chan_tag, channel if p == proc else 99, p)
+        backend.write('trigcode', code, 'RX82')
+        backend.play()
+        onsets[n] = time.perf_counter()
+        backend.wait_to_finish()
+    return onsets
+
+
+def benchmark(n_trials=100, soa=0.6, stimulus_duration=0.1, seed=0, **mock_kwargs):
+    """ onset timing of the per-trial upload loop and of TrialScheduler on MockBackend, with 20 % deviants """
+    try:
+        from oddball import oddball_sequence, trial_list
+    except ImportError:  # imported as elevation.stimulus_scheduler
+        from elevation.oddball import oddball_sequence, trial_list
+    rng = np.random.default_rng(seed)
+    trials = trial_list(oddball_sequence(n_trials, deviant_freq=0.2, seed=rng))
+    backend = MockBackend(**mock_kwargs)
+    stimulus = rng.uniform(-1, 1, int(stimulus_duration * backend.samplerate))
+    naive = per_trial_upload_loop(backend, trials, {'noise': stimulus}, isi=soa - stimulus_duration)
+    bank = StimulusBank(backend)
+    bank.add('noise', stimulus)
+    scheduled = TrialScheduler(backend, bank, soa=soa).run(trials)
+    return dict(per_trial_upload=timing_summary(naive, soa), scheduler=timing_summary(scheduled, soa),
+                uploads=bank.n_uploads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark trial timing on the mock processors')
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=2e-3, help='host round-trip in seconds')
+    parser.add_argument('--jitter', type=float, default=0.5e-3, help='sd of the round-trip in seconds')
+    args = parser.parse_args()
+    results = benchmark(args.trials, latency=args.latency, jitter=args.jitter)
+    for method in ('per_trial_upload', 'scheduler'):
+        print(f"{method:>16}: " + ', '.join(f'{key} {value:.2f} ms' for key, value in results[method].items()))
+    print(f"stimulus uploads with the scheduler: {results['uploads']}")
@@ -0,0 +1,254 @@
+"""
+Time-frequency helpers for the elevation EEG analysis (Morlet wavelet convolution).
+"""
+import hashlib
+import math
+import pathlib
+from collections import OrderedDict
+import numpy as np
+from array_cache import cached_array
+
+
+def morlet_wavelets(fs, frex, n_cycles, wavelet_duration=2.):
+    """ complex Morlet wavelets (freqs x time) and their time vector; n_cycles: scalar or one per frequency """
+    frex = np.atleast_1d(np.asarray(frex, dtype=float))
+    n_cycles = np.broadcast_to(np.asarray(n_cycles, dtype=float), frex.shape)
+    time = np.arange(-wavelet_duration / 2, wavelet_duration / 2, 1 / fs)
+    s = n_cycles / (2 * np.pi * frex)  # width of the gaussian in seconds
+    wavelets = (np.sqrt(1 / (s[:, None] * np.sqrt(np.pi)))  # empirical scaling factor for varying wavelet cycles
+                # complex sine at different frequencies
+                * np.exp(2 * 1j * np.pi * frex[:, None] * time)
+                # gaussian with s cycles
+                * np.exp(-time ** 2 / (2 * (s[:, None] ** 2))))
+    return time, wavelets
+
+
+def conv_length(n_data, n_wavelet):
+    """ length of the full linear convolution and the power of two used for the fft """
+    n_convolution = n_wavelet + n_data - 1
+    return n_convolution, 2 ** (math.ceil(math.log(n_convolution, 2)))
+
+
+def wavelet_ffts(wavelets, n_fft):
+    """ rffts of the real and imaginary parts of the wavelets (a real signal is convolved with each part) """
+    return np.fft.rfft(wavelets.real, n_fft), np.fft.rfft(wavelets.imag, n_fft)
+
+
+class WaveletBank:
+    """ LRU cache of wavelet ffts (max_size banks in memory), also saved as .npy files in cache_dir if given """
+
+    def __init__(self, max_size=8, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else None
+        self._banks = OrderedDict()
+
+    @staticmethod
+    def key(fs, frex, n_cycles, n_fft, wavelet_duration=2.):
+        frex = np.atleast_1d(np.asarray(frex, dtype=float))
+        n_cycles = np.broadcast_to(np.asarray(n_cycles, dtype=float), frex.shape)
+        h = hashlib.sha1()
+        h.update(np.array([fs, n_fft, wavelet_duration], dtype=float).tobytes())
+        h.update(np.ascontiguousarray(frex).tobytes())
+        h.update(np.ascontiguousarray(n_cycles).tobytes())
+        return h.hexdigest()
+
+    def get(self, fs, frex, n_cycles, n_fft, wavelet_duration=2.):
+        """ returns (real part fft, imaginary part fft), each freqs x (n_fft // 2 + 1) """
+
+        def compute():
+            _, wavelets = morlet_wavelets(fs, frex, n_cycles, wavelet_duration)
+            return np.stack(wavelet_ffts(wavelets, n_fft))
+
+        bank = cached_array(self._banks, f'wavelets_{self.key(fs, frex, n_cycles, n_fft, wavelet_duration)}', compute,
+                            self.max_size, self.cache_dir)
+        return bank[0], bank[1]
+
+    def clear(self):
+        self._banks.clear()
+
+
+# shared by all calls that don't pass their own bank
+default_bank = WaveletBank()
+
+
+def morlet_power(data, fs, frex, n_cycles, n_fft=None, freq_chunk=4, dtype=np.float64, out=None,
+                 wavelet_duration=2., bank=None):
+    """
+    Morlet power (channels x freqs x samples) of (channels x samples) data, or (freqs x samples) of one channel.
+    Frequencies are convolved freq_chunk at a time; out: optional preallocated (e.g. memory-mapped) result.
+    """
+    data = np.asarray(data)
+    single_channel = data.ndim == 1
+    data = np.atleast_2d(data)
+    n_channels, n_data = data.shape
+    n_wavelet = len(np.arange(-wavelet_duration / 2, wavelet_duration / 2, 1 / fs))
+    n_convolution, n_conv_pow2 = conv_length(n_data, n_wavelet)
+    if n_fft is None:
+        n_fft = n_conv_pow2
+    elif n_fft < n_convolution:
+        raise ValueError(f'n_fft={n_fft} is shorter than the linear convolution ({n_convolution} samples)')
+    half_of_wavelet_size = int((n_wavelet - 1) / 2)
+    start = half_of_wavelet_size + 1
+    wavelet_fft_re, wavelet_fft_im = (bank or default_bank).get(fs, frex, n_cycles, n_fft, wavelet_duration)
+    return _convolve_power(data, wavelet_fft_re, wavelet_fft_im, n_fft, start, n_data,
+                           freq_chunk, dtype, out, single_channel)
+
+
+def _convolve_power(data, wavelet_fft_re, wavelet_fft_im, n_fft, start, n_keep, freq_chunk, dtype, out,
+                    single_channel=False):
+    # data: (n x samples), wavelet ffts: (freqs x n_fft // 2 + 1); returns (n x freqs x n_keep) power
+    n_rows = data.shape[0]
+    num_frex = wavelet_fft_re.shape[0]
+    if out is None:
+        out = np.empty((n_rows, num_frex, n_keep), dtype=dtype)
+    elif out.shape != (n_rows, num_frex, n_keep):
+        raise ValueError(f'out has shape {out.shape}, expected {(n_rows, num_frex, n_keep)}')
+    data_fft = np.fft.rfft(data, n_fft)[:, None, :]  # one fft per channel, reused for all frequencies
+    for f0 in range(0, num_frex, freq_chunk):
+        chunk = slice(f0, min(f0 + freq_chunk, num_frex))
+        conv_re = np.fft.irfft(data_fft * wavelet_fft_re[chunk], n_fft)[..., start:start + n_keep]
+        conv_im = np.fft.irfft(data_fft * wavelet_fft_im[chunk], n_fft)[..., start:start + n_keep]
+        out[:, chunk] = conv_re ** 2 + conv_im ** 2
+    return out[0] if single_channel else out
+
+
+def _segments(data, onsets, rel):
+    # channels x events x segment samples around the onsets, zeros outside the recording
+    n_data = data.shape[1]
+    idx = onsets[:, None] + rel
+    inside = (idx >= 0) & (idx < n_data)
+    return data[:, np.clip(idx, 0, n_data - 1)] * inside
+
+
+def event_locked_power(data, onsets, fs, frex, n_cycles, tmin, tmax, event_chunk=64, freq_chunk=4,
+                       dtype=np.float64, wavelet_duration=2., bank=None):
+    """
+    Morlet power (events x channels x freqs x times) in the windows [onset + int(fs * tmin), onset + int(fs * tmax)),
+    same as slicing morlet_power() of the whole recording but only the windows (plus wavelet padding) are convolved
+    """
+    data = np.asarray(data)
+    single_channel = data.ndim == 1
+    data = np.atleast_2d(data)
+    n_channels = data.shape[0]
+    onsets = np.asarray(onsets, dtype=np.int64)
+    n_wavelet = len(np.arange(-wavelet_duration / 2, wavelet_duration / 2, 1 / fs))
+    half_of_wavelet_size = int((n_wavelet - 1) / 2)
+    # samples needed left and right of the window so the convolution inside it is exact
+    pad_left, pad_right = n_wavelet - 2 - half_of_wavelet_size, half_of_wavelet_size + 1
+    n_times = int(tmax * fs - tmin * fs)
+    n_segment = pad_left + n_times + pad_right
+    n_fft = 2 ** math.ceil(math.log(n_segment, 2))  # wrap-around only touches the discarded edges
+    wavelet_fft_re, wavelet_fft_im = (bank or default_bank).get(fs, frex, n_cycles, n_fft, wavelet_duration)
+    num_frex = wavelet_fft_re.shape[0]
+    epoch_tf = np.empty((len(onsets), n_channels, num_frex, n_times), dtype=dtype)
+    rel = np.arange(n_segment) + int(fs * tmin) - pad_left
+    for e0 in range(0, len(onsets), event_chunk):
+        segments = _segments(data, onsets[e0:e0 + event_chunk], rel)  # channels x events x segment samples
+        segments = segments.transpose(1, 0, 2).reshape(-1, n_segment)
+        power = _convolve_power(segments, wavelet_fft_re, wavelet_fft_im, n_fft, n_wavelet - 1, n_times,
+                                freq_chunk, dtype, None)
+        epoch_tf[e0:e0 + event_chunk] = power.reshape(-1, n_channels, num_frex, n_times)
+    return epoch_tf[:, 0] if single_channel else epoch_tf
+
+
+def event_locked_tfr(data, events, event_id, fs, frex, n_cycles, tmin, tmax, decim=1, event_chunk=64, freq_chunk=4,
+                     dtype=np.float32, wavelet_duration=2., bank=None):
+    """
+    Average power and inter-trial phase coherence per condition in one pass over chunks of events and frequencies,
+    keeping every decim-th sample (as mne's decim). Windows as event_locked_power.
+    Returns ({condition: power}, {condition: itc}, {condition: n events}), channels x freqs x times each.
+    """
+    data = np.asarray(data)
+    single_channel = data.ndim == 1
+    data = np.atleast_2d(data)
+    n_channels = data.shape[0]
+    events = np.asarray(events)
+    events = events[np.isin(events[:, 2], list(event_id.values()))]
+    n_wavelet = len(np.arange(-wavelet_duration / 2, wavelet_duration / 2, 1 / fs))
+    half_of_wavelet_size = int((n_wavelet - 1) / 2)
+    pad_left, pad_right = n_wavelet - 2 - half_of_wavelet_size, half_of_wavelet_size + 1
+    n_times = int(tmax * fs - tmin * fs)
+    n_segment = pad_left + n_times + pad_right
+    n_fft = 2 ** math.ceil(math.log(n_segment, 2))
+    wavelet_fft_re, wavelet_fft_im = (bank or default_bank).get(fs, frex, n_cycles, n_fft, wavelet_duration)
+    num_frex = wavelet_fft_re.shape[0]
+    keep = slice(n_wavelet - 1, n_wavelet - 1 + n_times, decim)  # decimated window samples of the convolution
+    n_kept = len(range(n_times)[::decim])
+    names = [name for name, code in event_id.items() if np.any(events[:, 2] == code)]
+    power = {name: np.zeros((n_channels, num_frex, n_kept), dtype=dtype) for name in names}
+    phase = {name: np.zeros((n_channels, num_frex, n_kept), dtype=np.complex64 if dtype == np.float32
+                            else np.complex128) for name in names}
+    counts = {name: int(np.sum(events[:, 2] == event_id[name])) for name in names}
+    rel = np.arange(n_segment) + int(fs * tmin) - pad_left
+    for e0 in range(0, len(events), event_chunk):
+        chunk_events = events[e0:e0 + event_chunk]
+        segments = _segments(data, chunk_events[:, 0], rel)  # channels x events x segment samples
+        data_fft = np.fft.rfft(segments, n_fft)[..., None, :]  # channels x events x 1 x freqs of the fft
+        for f0 in range(0, num_frex, freq_chunk):
+            fchunk = slice(f0, min(f0 + freq_chunk, num_frex))
+            conv_re = np.fft.irfft(data_fft * wavelet_fft_re[fchunk], n_fft)[..., keep]
+            conv_im = np.fft.irfft(data_fft * wavelet_fft_im[fchunk], n_fft)[..., keep]
+            trial_power = conv_re ** 2 + conv_im ** 2  # channels x events x freqs x times
+            magnitude = np.sqrt(trial_power)
+            magnitude[magnitude == 0] = 1.
+            unit = (conv_re + 1j * conv_im) / magnitude
+            for name in names:
+                sel = chunk_events[:, 2] == event_id[name]
+                if sel.any():
+                    power[name][:, fchunk] += trial_power[:, sel].sum(axis=1)
+                    phase[name][:, fchunk] += unit[:, sel].sum(axis=1)
+    itc = {}
+    for name in names:
+        power[name] /= counts[name]
+        itc[name] = (np.abs(phase.pop(name)) / counts[name]).astype(dtype)
+        if single_channel:
+            power[name], itc[name] = power[name][0], itc[name][0]
+    return power, itc, counts
+
+
+def gather_epochs(power, onsets, fs, tmin, tmax):
+    """ windows [onset + int(fs * tmin), onset + int(fs * tmax)) of continuous power, events x ... x times """
+    onsets = np.asarray(onsets, dtype=np.int64)
+    n_times = int(tmax * fs - tmin * fs)
+    starts = onsets + int(fs * tmin)
+    if len(starts) and (starts.min() < 0 or starts.max() + n_times > power.shape[-1]):
+        raise ValueError('epoch window exceeds the recording for at least one event')
+    windows = np.lib.stride_tricks.sliding_window_view(power, n_times, axis=-1)  # ... x samples x times, no copy
+    return np.moveaxis(windows[..., starts, :], -2, 0)
+
+
+def baseline_normalize(epoch_tf, fs, tmin, baseline=(None, 0), mode='ratio'):
+    """
+    Normalize power (... x times) by its baseline period, separately for every epoch, channel and frequency.
+    baseline: (start, stop) in seconds relative to the event, None meaning the epoch start / end.
+    mode: 'ratio' (x / mean), 'db' (10 * log10(x / mean)), 'percent' ((x - mean) / mean * 100)
+    or 'zscore' ((x - mean) / std).
+    """
+    n_times = epoch_tf.shape[-1]
+    b0 = 0 if baseline[0] is None else int(round((baseline[0] - tmin) * fs))
+    b1 = n_times if baseline[1] is None else int(round((baseline[1] - tmin) * fs))
+    base = epoch_tf[..., b0:b1]
+    mean = base.mean(axis=-1, keepdims=True)
+    if mode == 'ratio':
+        return epoch_tf / mean
+    elif mode == 'db':
+        return 10 * np.log10(epoch_tf / mean)
+    elif mode == 'percent':
+        return (epoch_tf - mean) / mean * 100
+    elif mode == 'zscore':
+        return (epoch_tf - mean) / base.std(axis=-1, keepdims=True)
+    raise ValueError(f"unknown baseline mode '{mode}', use 'ratio', 'db', 'percent' or 'zscore'")
+
+
+def condition_averages(epoch_tf, codes, event_id):
+    """ average epochs (events x ...) per condition; returns {condition name: averaged TF map} """
+    codes = np.asarray(codes)
+    return {name: epoch_tf[codes == code].mean(axis=0) for name, code in event_id.items() if np.any(codes == code)}
+
+
+def condition_tf(power, events, event_id, fs, tmin, tmax, baseline=(None, 0), mode='ratio'):
+    """ epoch continuous power around the events, baseline-normalize and average per condition """
+    events = events[np.isin(events[:, 2], list(event_id.values()))]
+    epoch_tf = gather_epochs(power, events[:, 0], fs, tmin, tmax)
+    epoch_tf = baseline_normalize(epoch_tf, fs, tmin, baseline, mode)
+    return condition_averages(epoch_tf, events[:, 2], event_id)
@@ -0,0 +1,151 @@
+"""
+Per-trial timing of stimulus presentation: every processor call is timestamped into a binary log per block:
+    log = TimingLog(eeg_DIR / 'timing' / f'{subj}_{block}.tlog')
+    backend = TimedBackend(FreefieldBackend(), log)  # use it like the backend it wraps
+    ...
+    log.flush()
+    print(timing_report(*read_timing_log(fname), soa=0.6))
+"""
+import json
+import pathlib
+import struct
+import time
+import numpy as np
+
+stages = ('upload', 'playbuflen', 'chan', 'trigcode', 'write', 'play', 'wait_to_finish', 'wait_for_button')
+record_dtype = np.dtype([('trial', '<i4'), ('stage', 'u1'), ('start', '<i8'), ('end', '<i8')])  # times in ns
+_stage = {name: i for i, name in enumerate(stages)}
+_magic = b'TLOG'
+_header = struct.Struct('<4sHI')  # magic, version, length of the json metadata
+
+
+class TimingLog:
+    """ preallocated (trial, stage, start, end) records, appended to fname by flush() or when the array is full """
+
+    def __init__(self, fname=None, capacity=8192, **meta):
+        self.fname = pathlib.Path(fname) if fname is not None else None
+        self.records = np.zeros(capacity, dtype=record_dtype)
+        self.n = 0  # records in the array
+        self.n_flushed = 0  # records written to the file
+        # clock references to relate perf_counter_ns to wall clock time
+        self.meta = dict(stages=stages, perf_ns=time.perf_counter_ns(), wall_ns=time.time_ns(), **meta)
+        self._header_written = False
+
+    def record(self, trial, stage, start, end):
+        if self.n == len(self.records):
+            if self.fname is not None:
+                self.flush()
+            else:
+                self.records = np.concatenate([self.records, np.zeros_like(self.records)])
+        self.records[self.n] = (trial, stage, start, end)
+        self.n += 1
+
+    def flush(self):
+        """ append the records since the last flush to the file """
+        if self.fname is None:
+            return
+        if not self._header_written:
+            self.fname.parent.mkdir(parents=True, exist_ok=True)
+            meta = json.dumps(self.meta).encode()
+            with open(self.fname, 'wb') as f:
+                f.write(_header.pack(_magic, 1, len(meta)) + meta)
+            self._header_written = True
+        with open(self.fname, 'ab') as f:
+            f.write(self.records[:self.n].tobytes())
+        self.n_flushed += self.n
+        self.n = 0
+
+    def get_records(self):
+        """ records not flushed yet (all records if there is no file) """
+        return self.records[:self.n]
+
+
+def read_timing_log(fname):
+    """ (records, metadata) of a binary timing log """
+    with open(fname, 'rb') as f:
+        magic, version, meta_len = _header.unpack(f.read(_header.size))
+        if magic != _magic:
+            raise ValueError(f'{fname} is not a timing log')
+        meta = json.loads(f.read(meta_len))
+        records = np.frombuffer(f.read(), dtype=record_dtype)
+    return records, meta
+
+
+class TimedBackend:
+    """ stimulus_scheduler backend that logs every call (writes count to the next trial, play / waits to the last) """
+
+    def __init__(self, backend, log):
+        self.backend, self.log = backend, log
+        self.n_played = 0
+        self._write_stages = {backend.data_tag: _stage['upload'], backend.n_samples_tag: _stage['playbuflen'],
+                              backend.chan_tag: _stage['chan'], 'trigcode': _stage['trigcode']}
+
+    def __getattr__(self, name):
+        # tags, analog_processors, speaker(), samplerate ... of the wrapped backend
+        return getattr(self.backend, name)
+
+    def write(self, tag, value, processors):
+        start = time.perf_counter_ns()
+        self.backend.write(tag, value, processors)
+        self.log.record(self.n_played, self._write_stages.get(tag, _stage['write']), start, time.perf_counter_ns())
+
+    def play(self):
+        start = time.perf_counter_ns()
+        self.backend.play()
+        self.log.record(self.n_played, _stage['play'], start, time.perf_counter_ns())
+        self.n_played += 1
+
+    def wait_to_finish(self):
+        start = time.perf_counter_ns()
+        self.backend.wait_to_finish()
+        self.log.record(self.n_played - 1, _stage['wait_to_finish'], start, time.perf_counter_ns())
+
+    def wait_for_button(self):
+        start = time.perf_counter_ns()
+        self.backend.wait_for_button()
+        self.log.record(self.n_played - 1, _stage['wait_for_button'], start, time.perf_counter_ns())
+
+
+def onsets(records):
+    """ onset time of every trial (end of its play call) in seconds, by trial number """
+    play = records[records['stage'] == _stage['play']]
+    return play['end'][np.argsort(play['trial'], kind='stable')] / 1e9
+
+
+def timing_report(records, meta=None, soa=0.6, percentiles=(50, 95, 99)):
+    """ per-stage call durations and onset interval statistics and drift in ms, pauses left out """
+    report = dict(meta={key: value for key, value in (meta or {}).items() if key != 'stages'}, stages={})
+    for i, stage in enumerate(stages):
+        durations = (records['end'] - records['start'])[records['stage'] == i] / 1e6
+        if len(durations):
+            report['stages'][stage] = dict(n=len(durations), max=durations.max(),
+                                           **{f'p{p}': np.percentile(durations, p) for p in percentiles})
+    t = onsets(records)
+    if len(t) > 2:
+        pauses = np.unique(records['trial'][records['stage'] == _stage['wait_for_button']])
+        intervals = np.diff(t)
+        trial = np.arange(1, len(t))
+        keep = ~np.isin(trial - 1, pauses)
+        deviation = (intervals[keep] - soa) * 1e3
+        report['onsets'] = dict(n=len(t), mean_soa=intervals[keep].mean() * 1e3, jitter_sd=deviation.std(),
+                                drift_per_100=np.polyfit(trial[keep], deviation, 1)[0] * 100,
+                                accumulated_drift=deviation.sum())
+    return report
+
+
+def align_with_markers(records, marker_samples, sfreq):
+    """ linear fit of the marker times (one per trial) to the host onsets: clock ratio, offset, residuals in ms """
+    t = onsets(records)
+    marker_times = np.asarray(marker_samples, dtype=float) / sfreq
+    if len(marker_times) != len(t):
+        raise ValueError(f'{len(marker_times)} markers but {len(t)} played trials')
+    ratio, offset = np.polyfit(t - t[0], marker_times, 1)
+    residuals = (marker_times - (ratio * (t - t[0]) + offset)) * 1e3
+    return dict(ratio=ratio, offset=offset, residual_sd=residuals.std(), residual_max=np.abs(residuals).max(),
+                residuals=residuals)
+
+
+def marker_outliers(fname, events, sfreq, max_residual=10.):
+    """ mask of the trials whose marker is more than max_residual ms off the host onset mapped to the EEG clock """
+    records, _ = read_timing_log(fname)
+    return np.abs(align_with_markers(records, np.asarray(events)[:, 0], sfreq)['residuals']) > max_residual
@@ -0,0 +1,38 @@
+"""
+Process pools whose workers receive the large arrays once, in an initializer, instead of with every task:
+    with worker_pool(n_jobs, data=data) as pool:
+        results = map_tasks(pool, func, tasks)  # func reads shared['data']
+"""
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+shared = {}  # data shared with the worker processes (set once per worker by init_worker)
+
+
+def init_worker(data):
+    shared.clear()
+    shared.update(data)
+
+
+@contextlib.contextmanager
+def worker_pool(n_jobs, **data):
+    """
+    pool of n_jobs processes with data in shared; fork shares the arrays with the workers without pickling them
+    (spawn where fork doesn't exist). With n_jobs <= 1 the data is only set in this process and None is yielded
+    """
+    init_worker(data)
+    if n_jobs <= 1:
+        yield None
+        return
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context(method),
+                             initializer=init_worker, initargs=(data,)) as pool:
+        yield pool
+
+
+def map_tasks(pool, func, tasks):
+    """ [func(*task) for task in tasks], on the pool if there is one """
+    if pool is None:
+        return [func(*task) for task in tasks]
+    return [future.result() for future in [pool.submit(func, *task) for task in tasks]]
@@ -1,6 +1,9 @@
-import freefield
 import slab
 import os
+import pathlib
+import time
+from elevation.stimulus_scheduler import FreefieldBackend, StimulusBank, TrialScheduler
+from elevation.trial_timing import TimingLog, TimedBackend
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 slab.set_default_samplerate(44100)
@@ -10,22 +13,21 @@ tone2 = slab.Sound.tone(duration=0.25, level=90, frequency=2000)
 tone1 = tone1.ramp(when='both', duration=0.01)
 tone2 = tone2.ramp(when='both', duration=0.01)
 
-silence = slab.Sound.silence(duration=0.6)
-stims = [slab.Sound.sequence(tone1, silence), slab.Sound.sequence(tone2, silence)]
-
-freefield.initialize('dome', zbus=True, default='play_rec')
-freefield.set_logger('WARNING')
+# each tone is uploaded only when the other one was played before, the 600 ms silence is timed by the scheduler
+timing_DIR = pathlib.Path.cwd() / 'elevation' / 'data' / 'timing'
+timing_log = TimingLog(timing_DIR / time.strftime('single_tone_%Y%m%d_%H%M%S.tlog'))  # timestamps of all calls
+backend = TimedBackend(FreefieldBackend('dome', default='play_rec', zbus=True), timing_log)
+bank = StimulusBank(backend)
+bank.add(1, tone1)
+bank.add(2, tone2)
 
 # seq = slab.Trialsequence(conditions=300)
-seq = slab.Trialsequence(conditions=stims, n_reps=100)
-
-for trial in seq:
-    # print(seq.trials[seq.this_n])
-    freefield.set_signal_and_speaker(signal=trial, speaker=23, equalize=False)
-    freefield.write(tag='trigcode', value=seq.trials[seq.this_n], processors='RX82')
-    freefield.play()
-    print('Playing stimulus:', seq.this_n + 1)
-    freefield.wait_to_finish_playing()
+seq = slab.Trialsequence(conditions=2, n_reps=100)
+
+# trials: (tone, central speaker, trigger code = tone number)
+trials = [(condition, 23, condition) for condition in seq.trials]
+TrialScheduler(backend, bank, soa=0.85).run(trials, on_trial=lambda n, trial: print('Playing stimulus:', n + 1))
+timing_log.flush()
 
 
 